@@ -1,50 +1,199 @@
+import logging
 import os
+from collections import Counter
+from typing import List, Optional
 
 from bson import ObjectId
 from celery import Celery
+from celery.signals import (
+    before_task_publish,
+    task_postrun,
+    task_prerun,
+    worker_init,
+    worker_process_init,
+    worker_process_shutdown,
+)
+from core import metrics
+from core.config import get_settings
+from db.stats import FIELD, STATS_COLLECTION, increments
 from dotenv import load_dotenv
-from pymongo import MongoClient
+from kombu import Exchange, Queue
+from prometheus_client import start_http_server
+from pymongo import MongoClient, UpdateOne
+from pymongo.collection import Collection
+from pymongo.database import Database
+from pymongo.errors import PyMongoError
 
 load_dotenv(".env")
 
+logger = logging.getLogger(__name__)
+
 broker = os.getenv("CELERY_BROKER_URL")
 backend = os.getenv("CELERY_BROKER_URL")
 celery = Celery("fast-api-tasks", broker=broker, backend=backend)
 
+settings = get_settings()
+
+# Workers consume both queues unless told otherwise with -Q,
+# see docker-compose.split-workers.yml
+celery.conf.task_queues = [
+    Queue(name, Exchange(name), routing_key=name)
+    for name in (settings.celery_fast_queue, settings.celery_bulk_queue)
+]
+celery.conf.task_default_queue = settings.celery_fast_queue
+
+# One client per worker process, opened after the fork
+mongo_client: Optional[MongoClient] = None
+
+
+@worker_process_init.connect
+def open_mongo_client(**kwargs) -> MongoClient:
+    global mongo_client
+    mongo_client = MongoClient(settings.db_uri, **settings.client_options())
+    return mongo_client
+
+
+@worker_process_shutdown.connect
+def close_mongo_client(**kwargs):
+    global mongo_client
+    if mongo_client is not None:
+        mongo_client.close()
+        mongo_client = None
+
+
+if settings.metrics_enabled:
+    before_task_publish.connect(metrics.stamp_published)
+    task_prerun.connect(metrics.task_started)
+    task_postrun.connect(metrics.task_finished)
+    worker_process_shutdown.connect(metrics.mark_process_dead)
+
+
+@worker_init.connect
+def serve_metrics(**kwargs):
+    """
+    Serve the metrics of the worker, and of its pool processes when
+    PROMETHEUS_MULTIPROC_DIR is set, on WORKER_METRICS_PORT
+    """
+    if settings.metrics_enabled and settings.worker_metrics_port:
+        start_http_server(
+            settings.worker_metrics_port, registry=metrics.metrics_registry()
+        )
+
+
+def get_database() -> Database:
+    """
+    Database of the process wide client.
+    Solo/thread pools and eager tasks never fire worker_process_init,
+    so the client is opened on first use there.
+    """
+    client = mongo_client
+    if client is None:
+        client = open_mongo_client()
+    return client.get_database(settings.db_name)
+
+
+def get_books_collection() -> Collection:
+    return get_database().books
 
-mongo_uri = os.getenv("MONGODB_URL")
+
+def count_checked_out(owner: ObjectId, authors: Counter):
+    """
+    Add books the tasks checked out to the loan counters, see db.stats
+    """
+    amounts = increments(Counter({owner: sum(authors.values())}), authors, 1)
+    if not amounts:
+        return
+    # The books are checked out either way, never fail the task here
+    try:
+        get_database()[STATS_COLLECTION].bulk_write(
+            [
+                UpdateOne({"_id": key}, {"$inc": {FIELD: n}}, upsert=True)
+                for key, n in amounts.items()
+            ],
+            ordered=False,
+        )
+    except PyMongoError as e:
+        logger.warning("Loan counters drifted by %s: %s", amounts, e)
 
 
 @celery.task(name="checkout")
 def checkout(book_id: str, user_id: str):
     processed_ids = []
     not_processed_ids = []
-    with MongoClient(mongo_uri) as conn:
-        db = conn.get_database("library")
-        books_collection = db.books
-        try:
-            book = books_collection.find_one({"_id": ObjectId(book_id)})
-
-            # If books is not found.
-            if not book:
-                raise ValueError("No book found!")
-
-            # If book is already checked out
-            if book["checked_out_by"] is not None:
-                raise TypeError("Field is not empty!")
-
-            # Update the book
-            updated = books_collection.update_one(
-                {"_id": ObjectId(book_id)},
-                {"$set": {"checked_out_by": ObjectId(user_id)}},
-            )
-
-            if updated.acknowledged and updated.modified_count == 1:
-                processed_ids.append(book_id)
-
-        except (ValueError, TypeError, AttributeError):
-            not_processed_ids.append(book_id)
+    books_collection = get_books_collection()
+    try:
+        book = books_collection.find_one({"_id": ObjectId(book_id)})
+
+        # If books is not found.
+        if not book:
+            raise ValueError("No book found!")
+
+        # If book is already checked out
+        if book["checked_out_by"] is not None:
+            raise TypeError("Field is not empty!")
+
+        # Update the book
+        updated = books_collection.update_one(
+            {"_id": ObjectId(book_id)},
+            {"$set": {"checked_out_by": ObjectId(user_id)}},
+        )
+
+        if updated.acknowledged and updated.modified_count == 1:
+            processed_ids.append(book_id)
+            count_checked_out(ObjectId(user_id), Counter([book.get("author")]))
+
+    except (ValueError, TypeError, AttributeError):
+        not_processed_ids.append(book_id)
     return {
         "processed_ids": processed_ids,
         "not_processed_ids": not_processed_ids,
     }
+
+
+@celery.task(name="checkout_chunk")
+def checkout_chunk(book_ids: List[str], user_id: str):
+    """
+    Checkout a chunk of books with a single conditional update.
+    Only books that are not checked out are updated, the returned
+    lists tell exactly which of the given ids were checked out.
+    """
+    # Keep the callers spelling of the ids for the response
+    requested = {ObjectId(b): b for b in book_ids if ObjectId.is_valid(b)}
+    owner = ObjectId(user_id)
+    processed = []
+    books_collection = get_books_collection()
+    # Authors come along for the loan counters
+    authors = {
+        res["_id"]: res.get("author")
+        for res in books_collection.find(
+            {"_id": {"$in": list(requested)}, "checked_out_by": None},
+            {"author": 1},
+        )
+    }
+    available = list(authors)
+    if available:
+        updated = books_collection.update_many(
+            {"_id": {"$in": available}, "checked_out_by": None},
+            {"$set": {"checked_out_by": owner}},
+        )
+        if updated.modified_count == len(available):
+            processed = available
+        else:
+            # Some books were taken in between, ask which ones we got
+            processed = [
+                res["_id"]
+                for res in books_collection.find(
+                    {"_id": {"$in": available}, "checked_out_by": owner},
+                    {"_id": 1},
+                )
+            ]
+
+    if processed:
+        count_checked_out(owner, Counter(authors[oid] for oid in processed))
+
+    processed_ids = [requested[oid] for oid in processed]
+    done = set(processed_ids)
+    return {
+        "processed_ids": processed_ids,
+        "not_processed_ids": [b for b in book_ids if b not in done],
+    }
@@ -1,3 +1,8 @@
+from functools import lru_cache
+from typing import Any, Dict, Literal, Optional
+
+from core.metrics import mongo_command_metrics
+from fastapi import Request
 from pydantic import BaseSettings, Field
 
 
@@ -10,6 +15,160 @@ class Settings(BaseSettings):
     db_uri: str = Field(..., env="MONGODB_URL")
     db_name: str = Field(..., env="DB_NAME")
 
+    # Where the app keeps users and books: "mongo", or "memory" to
+    # load test the app without a database. Memory is per process and
+    # not seen by the celery worker, so checkouts never go to it then
+    storage_engine: Literal["mongo", "memory"] = Field(
+        "mongo", env="STORAGE_ENGINE"
+    )
+
+    # Connection pool of the mongo clients
+    db_max_pool_size: int = Field(100, env="DB_MAX_POOL_SIZE")
+    db_min_pool_size: int = Field(0, env="DB_MIN_POOL_SIZE")
+    db_connect_timeout_ms: int = Field(20_000, env="DB_CONNECT_TIMEOUT_MS")
+    db_socket_timeout_ms: Optional[int] = Field(
+        None, env="DB_SOCKET_TIMEOUT_MS"
+    )
+    db_server_selection_timeout_ms: int = Field(
+        30_000, env="DB_SERVER_SELECTION_TIMEOUT_MS"
+    )
+    # Wire compression, e.g. "zstd,snappy,zlib". Off when empty
+    db_compressors: str = Field("", env="DB_COMPRESSORS")
+
+    # Create the indexes the app needs on startup
+    db_create_indexes: bool = Field(True, env="DB_CREATE_INDEXES")
+
+    # Read-through cache of models found by id, off by default
+    cache_enabled: bool = Field(False, env="CACHE_ENABLED")
+    cache_max_size: int = Field(10_000, env="CACHE_MAX_SIZE")
+    # Seconds an entry is served before it is read again
+    book_cache_ttl: float = Field(5, env="BOOK_CACHE_TTL")
+    user_cache_ttl: float = Field(30, env="USER_CACHE_TTL")
+
+    # In memory index of checked out books, kept current from a change
+    # stream, so checkouts skip taken books without a query. Needs a
+    # replica set
+    availability_index_enabled: bool = Field(
+        False, env="AVAILABILITY_INDEX_ENABLED"
+    )
+    # Seconds to wait before the change stream is opened again
+    availability_index_retry: float = Field(30, env="AVAILABILITY_INDEX_RETRY")
+
+    # Number of ids per query of the batch book lookup
+    lookup_chunk_size: int = Field(500, env="LOOKUP_CHUNK_SIZE")
+
+    # Number of books per insert_many of the bulk ingest
+    bulk_insert_chunk_size: int = Field(1_000, env="BULK_INSERT_CHUNK_SIZE")
+    # Characters a record of the bulk ingest may have, the rest of the
+    # body is rejected after a longer or malformed record
+    bulk_insert_max_record_size: int = Field(
+        1_048_576, env="BULK_INSERT_MAX_RECORD_SIZE"
+    )
+
+    # Passwords are hashed with "argon2" or "bcrypt" in a pool of
+    # PASSWORD_HASH_WORKERS threads, or processes, off the event loop.
+    # 0 workers hashes on the event loop, for comparison only
+    password_hash_algorithm: Literal["argon2", "bcrypt"] = Field(
+        "argon2", env="PASSWORD_HASH_ALGORITHM"
+    )
+    password_hash_pool: Literal["thread", "process"] = Field(
+        "thread", env="PASSWORD_HASH_POOL"
+    )
+    password_hash_workers: int = Field(4, env="PASSWORD_HASH_WORKERS")
+    # Cost of a hash. Memory is in KiB
+    argon2_time_cost: int = Field(2, env="ARGON2_TIME_COST")
+    argon2_memory_cost: int = Field(65_536, env="ARGON2_MEMORY_COST")
+    argon2_parallelism: int = Field(1, env="ARGON2_PARALLELISM")
+    bcrypt_rounds: int = Field(12, env="BCRYPT_ROUNDS")
+
+    # Exports read and encode this many books at a time. Parquet files
+    # get a row group per EXPORT_ROW_GROUP_SIZE books, which are held
+    # in memory until the group is written
+    export_batch_size: int = Field(5_000, env="EXPORT_BATCH_SIZE")
+    export_row_group_size: int = Field(100_000, env="EXPORT_ROW_GROUP_SIZE")
+
+    # Checkouts with at least this many books run as a celery job
+    checkout_async_threshold: int = Field(
+        10_000, env="CHECKOUT_ASYNC_THRESHOLD"
+    )
+    # Celery queues. Jobs of at least CHECKOUT_BULK_THRESHOLD books go
+    # to the bulk queue, so they never hold up smaller jobs
+    celery_fast_queue: str = Field("checkout-fast", env="CELERY_FAST_QUEUE")
+    celery_bulk_queue: str = Field("checkout-bulk", env="CELERY_BULK_QUEUE")
+    checkout_bulk_threshold: int = Field(50_000, env="CHECKOUT_BULK_THRESHOLD")
+    # Number of book ids a single celery checkout task works on
+    checkout_chunk_size: int = Field(1_000, env="CHECKOUT_CHUNK_SIZE")
+    # Checkouts too large to batch and too small for celery look up
+    # their books this many at a time, with this many lookups at once
+    checkout_prefetch_chunk_size: int = Field(
+        1_000, env="CHECKOUT_PREFETCH_CHUNK_SIZE"
+    )
+    checkout_prefetch_concurrency: int = Field(
+        4, env="CHECKOUT_PREFETCH_CONCURRENCY"
+    )
+    # Checkouts of at most this many books are merged with concurrent
+    # ones into batched writes. 0 turns batching off
+    checkout_batch_max_books: int = Field(50, env="CHECKOUT_BATCH_MAX_BOOKS")
+    # A batch is written once it holds this many books, or this many
+    # milliseconds after its first checkout
+    checkout_batch_max_items: int = Field(
+        1_000, env="CHECKOUT_BATCH_MAX_ITEMS"
+    )
+    checkout_batch_max_delay_ms: float = Field(
+        2, env="CHECKOUT_BATCH_MAX_DELAY_MS"
+    )
+
+    # Prometheus metrics of routes, mongo commands and celery tasks
+    metrics_enabled: bool = Field(True, env="METRICS_ENABLED")
+    # Port the celery worker serves its metrics on, none when unset
+    worker_metrics_port: Optional[int] = Field(None, env="WORKER_METRICS_PORT")
+
+    # Profiling of single requests, off by default. Requests are only
+    # profiled when they send `X-Profile: <PROFILING_TOKEN>`
+    profiling_enabled: bool = Field(False, env="PROFILING_ENABLED")
+    profiling_token: str = Field("", env="PROFILING_TOKEN")
+    # Seconds between two samples
+    profiling_interval: float = Field(0.001, env="PROFILING_INTERVAL")
+    # "html" or "speedscope"
+    profiling_format: Literal["html", "speedscope"] = Field(
+        "html", env="PROFILING_FORMAT"
+    )
+    profiling_dir: str = Field("profiles", env="PROFILING_DIR")
+    # Older profiles are deleted beyond this many
+    profiling_max_files: int = Field(100, env="PROFILING_MAX_FILES")
+
     class Config:
         env_prefix = ""
         env_file = ".env"
+
+    def client_options(self) -> Dict[str, Any]:
+        """
+        Keyword arguments for MongoClient/AsyncIOMotorClient
+        """
+        options: Dict[str, Any] = dict(
+            maxPoolSize=self.db_max_pool_size,
+            minPoolSize=self.db_min_pool_size,
+            connectTimeoutMS=self.db_connect_timeout_ms,
+            socketTimeoutMS=self.db_socket_timeout_ms,
+            serverSelectionTimeoutMS=self.db_server_selection_timeout_ms,
+        )
+        if self.db_compressors:
+            options["compressors"] = self.db_compressors
+        if self.metrics_enabled:
+            options["event_listeners"] = [mongo_command_metrics]
+        return options
+
+
+@lru_cache()
+def get_settings() -> Settings:
+    """
+    Settings are read once and shared. Can be used as a dependency.
+    """
+    return Settings()
+
+
+def get_app_settings(request: Request) -> Settings:
+    """
+    Settings of the app serving the request. To be used as a dependency.
+    """
+    return request.app.state.settings
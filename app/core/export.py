@@ -0,0 +1,222 @@
+import csv
+import io
+from abc import ABC, abstractmethod
+from typing import (
+    Any,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Literal,
+    Type,
+    get_args,
+)
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from bson import ObjectId
+from core.responses import dumps
+from models.pyobjectid import MongoModel
+
+
+def columns(model_cls: Type[MongoModel]) -> List[str]:
+    """
+    Names of the exported columns, the fields of the model as stored
+    """
+    return [field.alias for field in model_cls.__fields__.values()]
+
+
+def projection(model_cls: Type[MongoModel]) -> Dict[str, int]:
+    """
+    Mongo projection of the exported columns
+    """
+    return {name: 1 for name in columns(model_cls)}
+
+
+def cell(value: Any) -> Any:
+    if isinstance(value, ObjectId):
+        return str(value)
+    return value
+
+
+class Exporter(ABC):
+    """
+    Turns documents into the bytes of an export file, a batch at a time,
+    so a whole collection is written without holding it in memory.
+    The output of every call is the next part of the file.
+    """
+
+    media_type: str
+    extension: str
+
+    def __init__(self, model_cls: Type[MongoModel]):
+        self.columns = columns(model_cls)
+
+    @abstractmethod
+    def write(self, docs: List[dict]) -> bytes:
+        """
+        Encode a batch of documents
+        """
+
+    def close(self) -> bytes:
+        """
+        What is left of the file after the last batch
+        """
+        return b""
+
+
+class CsvExporter(Exporter):
+    """
+    One row per document behind a header row, empty cells for none
+    """
+
+    media_type = "text/csv"
+    extension = "csv"
+
+    def __init__(self, model_cls: Type[MongoModel]):
+        super().__init__(model_cls)
+        self._buffer = io.StringIO()
+        self._writer = csv.writer(self._buffer)
+        self._writer.writerow(self.columns)
+
+    def write(self, docs: List[dict]) -> bytes:
+        self._writer.writerows(
+            [cell(doc.get(name)) for name in self.columns] for doc in docs
+        )
+        out = self._buffer.getvalue().encode()
+        self._buffer.seek(0)
+        self._buffer.truncate()
+        return out
+
+
+class NdjsonExporter(Exporter):
+    """
+    One JSON object per line
+    """
+
+    media_type = "application/x-ndjson"
+    extension = "ndjson"
+
+    def write(self, docs: List[dict]) -> bytes:
+        return b"".join(
+            dumps({name: doc.get(name) for name in self.columns}) + b"\n"
+            for doc in docs
+        )
+
+
+class ChunkSink:
+    """
+    File that keeps what is written until it is taken. The parquet
+    writer needs a file that knows its position, its data is handed
+    out as soon as a row group is done.
+    """
+
+    closed = False
+
+    def __init__(self):
+        self._chunks: List[bytes] = []
+        self._position = 0
+
+    def write(self, data: bytes) -> int:
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self) -> bytes:
+        out = b"".join(self._chunks)
+        self._chunks.clear()
+        return out
+
+
+class ParquetExporter(Exporter):
+    """
+    Parquet file with one row group per `row_group_size` documents.
+    Documents are held until their row group is full.
+    """
+
+    media_type = "application/vnd.apache.parquet"
+    extension = "parquet"
+
+    def __init__(self, model_cls: Type[MongoModel], row_group_size: int):
+        super().__init__(model_cls)
+        self.row_group_size = row_group_size
+        self.schema = pa.schema(
+            [
+                (
+                    field.alias,
+                    pa.int64() if field.outer_type_ is int else pa.string(),
+                )
+                for field in model_cls.__fields__.values()
+            ]
+        )
+        self._rows: List[dict] = []
+        self._sink = ChunkSink()
+        self._writer = pq.ParquetWriter(self._sink, self.schema)
+
+    def write(self, docs: List[dict]) -> bytes:
+        self._rows += docs
+        while len(self._rows) >= self.row_group_size:
+            self._write_row_group(self._rows[: self.row_group_size])
+            del self._rows[: self.row_group_size]
+        return self._sink.take()
+
+    def close(self) -> bytes:
+        if self._rows:
+            self._write_row_group(self._rows)
+            self._rows = []
+        # Writes the footer
+        self._writer.close()
+        return self._sink.take()
+
+    def _write_row_group(self, docs: List[dict]):
+        table = pa.Table.from_pydict(
+            {
+                name: [cell(doc.get(name)) for doc in docs]
+                for name in self.columns
+            },
+            schema=self.schema,
+        )
+        self._writer.write_table(table, row_group_size=len(docs))
+
+
+ExportFormat = Literal["csv", "ndjson", "parquet"]
+FORMATS = get_args(ExportFormat)
+
+
+def make_exporter(
+    format: ExportFormat, model_cls: Type[MongoModel], row_group_size: int
+) -> Exporter:
+    """
+    Exporter of one of `FORMATS`
+    """
+    if format == "csv":
+        return CsvExporter(model_cls)
+    if format == "ndjson":
+        return NdjsonExporter(model_cls)
+    if format == "parquet":
+        return ParquetExporter(model_cls, row_group_size)
+    raise ValueError(f"Unknown export format {format}")
+
+
+def export(
+    exporter: Exporter, docs: Iterable[dict], batch_size: int
+) -> Iterator[bytes]:
+    """
+    Parts of the export file of `docs`, one per `batch_size` documents
+    """
+    batch: List[dict] = []
+    for doc in docs:
+        batch.append(doc)
+        if len(batch) >= batch_size:
+            yield exporter.write(batch)
+            batch = []
+    yield exporter.write(batch) + exporter.close()
@@ -0,0 +1,248 @@
+import os
+import time
+from typing import Dict, Optional
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+from pymongo import monitoring
+from starlette.requests import Request
+from starlette.responses import Response
+from starlette.routing import Match
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+# Labels only take values from small fixed sets: standard methods, route
+# templates (never raw paths), command and collection names, task names
+# and states.
+HTTP_REQUEST_SECONDS = Histogram(
+    "http_request_duration_seconds",
+    "Time spent handling HTTP requests",
+    ["method", "route", "status"],
+)
+HTTP_REQUESTS_IN_FLIGHT = Gauge(
+    "http_requests_in_flight",
+    "HTTP requests being handled",
+    ["method", "route"],
+    multiprocess_mode="livesum",
+)
+MONGO_COMMAND_SECONDS = Histogram(
+    "mongo_command_duration_seconds",
+    "Time spent on mongo commands",
+    ["command", "collection", "outcome"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25)
+    + (0.5, 1, 2.5, 5, 10),
+)
+CELERY_TASK_SECONDS = Histogram(
+    "celery_task_duration_seconds",
+    "Time spent running celery tasks",
+    ["task", "state"],
+)
+CELERY_TASK_QUEUE_SECONDS = Histogram(
+    "celery_task_queue_wait_seconds",
+    "Time celery tasks waited between publishing and running",
+    ["task"],
+)
+CELERY_TASKS = Counter(
+    "celery_tasks",
+    "Finished celery tasks",
+    ["task", "state"],
+)
+AVAILABILITY_INDEX_LAG = Gauge(
+    "availability_index_lag_seconds",
+    "Age of the last change applied to the availability index",
+    multiprocess_mode="liveall",
+)
+AVAILABILITY_INDEX_BOOKS = Gauge(
+    "availability_index_checked_out_books",
+    "Checked out books in the availability index",
+    multiprocess_mode="liveall",
+)
+AVAILABILITY_INDEX_BYTES = Gauge(
+    "availability_index_bytes",
+    "Approximate memory held by the availability index",
+    multiprocess_mode="liveall",
+)
+MODEL_CACHE_LOOKUPS = Counter(
+    "model_cache_lookups",
+    "Lookups of the model cache by id",
+    ["cache", "result"],
+)
+MODEL_CACHE_ENTRIES = Gauge(
+    "model_cache_entries",
+    "Entries held by the model cache",
+    ["cache"],
+    multiprocess_mode="liveall",
+)
+
+UNMATCHED_ROUTE = "unmatched"
+# Any other method, so clients can not add label values
+OTHER_METHOD = "other"
+HTTP_METHODS = {
+    "GET",
+    "HEAD",
+    "POST",
+    "PUT",
+    "PATCH",
+    "DELETE",
+    "OPTIONS",
+    "CONNECT",
+    "TRACE",
+}
+
+
+def metrics_registry() -> CollectorRegistry:
+    """
+    Registry to expose. With PROMETHEUS_MULTIPROC_DIR set,
+    metrics of every process writing to the directory are merged.
+    """
+    if "PROMETHEUS_MULTIPROC_DIR" not in os.environ:
+        return REGISTRY
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return registry
+
+
+def metrics(request: Request) -> Response:
+    """
+    Prometheus metrics of the app
+    """
+    return Response(
+        generate_latest(metrics_registry()), media_type=CONTENT_TYPE_LATEST
+    )
+
+
+def route_name(scope: Scope) -> str:
+    """
+    Path template of the route the request goes to, e.g. /books/{book_id}
+    """
+    partial = None
+    for route in scope["app"].routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return route.path
+        if match == Match.PARTIAL and partial is None:
+            partial = route.path
+    return partial or UNMATCHED_ROUTE
+
+
+class MetricsMiddleware:
+    """
+    Times every HTTP request and counts the ones in flight, by route
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        method = scope["method"]
+        if method not in HTTP_METHODS:
+            method = OTHER_METHOD
+        route = route_name(scope)
+        status = "500"
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = str(message["status"])
+            await send(message)
+
+        in_flight = HTTP_REQUESTS_IN_FLIGHT.labels(method, route)
+        in_flight.inc()
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            HTTP_REQUEST_SECONDS.labels(method, route, status).observe(
+                time.perf_counter() - started
+            )
+            in_flight.dec()
+
+
+class CommandMetrics(monitoring.CommandListener):
+    """
+    Times mongo commands by command and collection name.
+    To be passed in `event_listeners` of a client.
+    """
+
+    def __init__(self):
+        # The collection is only on the started event
+        self._collections: Dict[int, str] = {}
+
+    def started(self, event):
+        if event.command_name == "getMore":
+            collection = event.command.get("collection")
+        else:
+            collection = event.command.get(event.command_name)
+        if not isinstance(collection, str):
+            collection = ""
+        self._collections[event.request_id] = collection
+
+    def succeeded(self, event):
+        self._observe(event, "ok")
+
+    def failed(self, event):
+        self._observe(event, "failed")
+
+    def _observe(self, event, outcome: str):
+        collection = self._collections.pop(event.request_id, "")
+        MONGO_COMMAND_SECONDS.labels(
+            event.command_name, collection, outcome
+        ).observe(event.duration_micros / 1e6)
+
+
+mongo_command_metrics = CommandMetrics()
+
+# Start times of the tasks running in this process
+_task_started: Dict[str, float] = {}
+
+
+def stamp_published(headers: Optional[dict] = None, **kwargs):
+    """
+    before_task_publish handler, records when the task was sent
+    """
+    if headers is not None:
+        headers["published_at"] = time.time()
+
+
+def task_started(task_id: str, task, **kwargs):
+    """
+    task_prerun handler, observes how long the task was queued
+    """
+    _task_started[task_id] = time.perf_counter()
+    published_at = task.request.get("published_at")
+    if published_at:
+        CELERY_TASK_QUEUE_SECONDS.labels(task.name).observe(
+            max(0.0, time.time() - published_at)
+        )
+
+
+def task_finished(task_id: str, task, state: Optional[str] = None, **kwargs):
+    """
+    task_postrun handler, observes how long the task ran and how it ended
+    """
+    started = _task_started.pop(task_id, None)
+    state = state or "UNKNOWN"
+    CELERY_TASKS.labels(task.name, state).inc()
+    if started is not None:
+        CELERY_TASK_SECONDS.labels(task.name, state).observe(
+            time.perf_counter() - started
+        )
+
+
+def mark_process_dead(**kwargs):
+    """
+    worker_process_shutdown handler, drops the live gauges of the process
+    """
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        multiprocess.mark_process_dead(os.getpid())
@@ -0,0 +1,64 @@
+import struct
+from typing import Iterable, List, Optional
+
+from bson import ObjectId
+from bson.errors import InvalidId
+
+# Body of ObjectIds packed as their 12 raw bytes, back to back
+PACKED_MEDIA_TYPE = "application/octet-stream"
+OBJECT_ID_SIZE = 12
+# Header of a packed response, the number of ids in each of its lists
+COUNTS = struct.Struct("!II")
+
+
+def parse_object_ids(ids: List[str]) -> List[Optional[ObjectId]]:
+    """
+    Cast many string object ids at once. Ids that are not
+    valid object ids are none in the returned list.
+    """
+    # Usually every id is valid, then they are all decoded in one go
+    if all(isinstance(i, str) and len(i) == 24 for i in ids):
+        try:
+            raw = bytes.fromhex("".join(ids))
+        except ValueError:
+            raw = b""
+        if len(raw) == OBJECT_ID_SIZE * len(ids):
+            return unpack_object_ids(raw)
+    return [parse_object_id(i) for i in ids]
+
+
+def parse_object_id(oid: str) -> Optional[ObjectId]:
+    try:
+        return ObjectId(oid)
+    except (InvalidId, TypeError):
+        return None
+
+
+def unpack_object_ids(raw: bytes) -> List[ObjectId]:
+    """
+    ObjectIds of a packed body. Raise ValueError if it is cut short.
+    """
+    if len(raw) % OBJECT_ID_SIZE:
+        raise ValueError(f"Length is not a multiple of {OBJECT_ID_SIZE}")
+    return [
+        ObjectId(raw[i : i + OBJECT_ID_SIZE])
+        for i in range(0, len(raw), OBJECT_ID_SIZE)
+    ]
+
+
+def pack_object_ids(oids: Iterable[ObjectId]) -> bytes:
+    return b"".join(oid.binary for oid in oids)
+
+
+def pack_checkout_result(
+    processed: List[ObjectId], not_processed: List[ObjectId]
+) -> bytes:
+    """
+    Both lists packed one after the other,
+    behind a header with the number of ids in each
+    """
+    return (
+        COUNTS.pack(len(processed), len(not_processed))
+        + pack_object_ids(processed)
+        + pack_object_ids(not_processed)
+    )
@@ -0,0 +1,93 @@
+import logging
+import re
+import secrets
+import time
+from pathlib import Path
+
+from core.config import Settings
+from pyinstrument import Profiler
+from pyinstrument.renderers import HTMLRenderer, SpeedscopeRenderer
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+logger = logging.getLogger(__name__)
+
+PROFILE_HEADER = "x-profile"
+PROFILE_FILE_HEADER = b"x-profile-file"
+RENDERERS = {
+    "html": (HTMLRenderer, "html"),
+    "speedscope": (SpeedscopeRenderer, "speedscope.json"),
+}
+
+
+class ProfilingMiddleware:
+    """
+    Samples requests that carry `X-Profile: <PROFILING_TOKEN>` and saves
+    one profile per request to PROFILING_DIR. Every other request
+    goes straight through.
+    """
+
+    def __init__(self, app: ASGIApp, settings: Settings):
+        self.app = app
+        self.token = settings.profiling_token
+        self.interval = settings.profiling_interval
+        self.renderer, self.suffix = RENDERERS[settings.profiling_format]
+        self.directory = Path(settings.profiling_dir)
+        self.max_files = settings.profiling_max_files
+
+    def wants_profile(self, scope: Scope) -> bool:
+        if scope["type"] != "http" or not self.token:
+            return False
+        header = Headers(scope=scope).get(PROFILE_HEADER)
+        return header is not None and secrets.compare_digest(
+            header, self.token
+        )
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if not self.wants_profile(scope):
+            await self.app(scope, receive, send)
+            return
+
+        path = re.sub(r"[^\w.-]+", "_", scope["path"]).strip("_")
+        name = (
+            f"{time.strftime('%Y%m%dT%H%M%S')}-{secrets.token_hex(3)}"
+            f"-{scope['method']}-{path or 'index'}.{self.suffix}"
+        )
+
+        async def send_with_file(message):
+            # Tell the caller which file holds the profile
+            if message["type"] == "http.response.start":
+                headers = list(message.get("headers", []))
+                headers.append((PROFILE_FILE_HEADER, name.encode()))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        profiler = Profiler(interval=self.interval, async_mode="enabled")
+        profiler.start()
+        try:
+            await self.app(scope, receive, send_with_file)
+        finally:
+            profiler.stop()
+            # Rendering a long profile takes a while, keep it off the loop
+            await run_in_threadpool(self.save, profiler, name)
+
+    def save(self, profiler: Profiler, name: str):
+        try:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            output = profiler.output(self.renderer())
+            (self.directory / name).write_text(output)
+            self.prune()
+        except OSError:
+            logger.exception("Could not save profile %s", name)
+
+    def prune(self):
+        """
+        Drop the oldest profiles beyond PROFILING_MAX_FILES
+        """
+        profiles = sorted(
+            self.directory.glob(f"*.{self.suffix}"),
+            key=lambda p: p.stat().st_mtime,
+        )
+        for old in profiles[: max(0, len(profiles) - self.max_files)]:
+            old.unlink(missing_ok=True)
@@ -0,0 +1,34 @@
+from typing import Any
+
+import orjson
+from bson.objectid import ObjectId
+from pydantic import BaseModel
+from starlette.responses import JSONResponse
+
+
+def _default(obj: Any) -> Any:
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    if isinstance(obj, BaseModel):
+        return obj.dict(by_alias=True)
+    raise TypeError
+
+
+def dumps(content: Any) -> bytes:
+    """
+    Serialize to JSON with orjson, ObjectIds and models included
+    """
+    return orjson.dumps(content, default=_default)
+
+
+class MongoJSONResponse(JSONResponse):
+    """
+    JSON response rendered with orjson.
+
+    Routes returning it directly skip FastAPI's jsonable_encoder,
+    models and ObjectIds are serialized by `dumps` instead.
+    Remember to pass the status code when returning it.
+    """
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
@@ -0,0 +1,117 @@
+import asyncio
+from concurrent.futures import (
+    Executor,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+)
+from typing import NamedTuple, Optional
+
+import argon2
+import bcrypt
+from argon2.exceptions import InvalidHash, VerificationError
+from core.config import Settings
+from fastapi import Request
+
+
+class HashParams(NamedTuple):
+    """
+    Algorithm and cost of new hashes. Plain values, so they can be
+    sent to the processes of a pool.
+    """
+
+    algorithm: str
+    argon2_time_cost: int
+    argon2_memory_cost: int
+    argon2_parallelism: int
+    bcrypt_rounds: int
+
+    @classmethod
+    def from_settings(cls, settings: Settings) -> "HashParams":
+        return cls(
+            settings.password_hash_algorithm,
+            settings.argon2_time_cost,
+            settings.argon2_memory_cost,
+            settings.argon2_parallelism,
+            settings.bcrypt_rounds,
+        )
+
+    def argon2_hasher(self) -> argon2.PasswordHasher:
+        return argon2.PasswordHasher(
+            time_cost=self.argon2_time_cost,
+            memory_cost=self.argon2_memory_cost,
+            parallelism=self.argon2_parallelism,
+        )
+
+
+def hash_password(password: str, params: HashParams) -> str:
+    if params.algorithm == "bcrypt":
+        salt = bcrypt.gensalt(params.bcrypt_rounds)
+        return bcrypt.hashpw(password.encode(), salt).decode()
+    return params.argon2_hasher().hash(password)
+
+
+def verify_password(password: str, hashed: str, params: HashParams) -> bool:
+    """
+    Whether `password` matches `hashed`. The algorithm is taken from
+    the hash, so hashes made before a change of algorithm still verify.
+    Anything that is not a hash matches no password.
+    """
+    if hashed.startswith("$argon2"):
+        try:
+            return params.argon2_hasher().verify(hashed, password)
+        except (VerificationError, InvalidHash):
+            return False
+    if hashed.startswith("$2"):
+        try:
+            return bcrypt.checkpw(password.encode(), hashed.encode())
+        except ValueError:
+            return False
+    return False
+
+
+class PasswordHasher:
+    """
+    Hashes and verifies passwords in a pool of `password_hash_workers`
+    threads or processes. A hash takes tens of milliseconds of CPU on
+    purpose, on the event loop it would hold up every other request.
+    Both algorithms release the GIL while hashing, so threads run
+    hashes in parallel too.
+    """
+
+    def __init__(self, settings: Settings):
+        self.params = HashParams.from_settings(settings)
+        self.executor: Optional[Executor] = None
+        workers = settings.password_hash_workers
+        if workers > 0:
+            if settings.password_hash_pool == "process":
+                self.executor = ProcessPoolExecutor(workers)
+            else:
+                self.executor = ThreadPoolExecutor(
+                    workers, thread_name_prefix="password-hash"
+                )
+
+    async def hash(self, password: str) -> str:
+        if self.executor is None:
+            return hash_password(password, self.params)
+        return await asyncio.get_event_loop().run_in_executor(
+            self.executor, hash_password, password, self.params
+        )
+
+    async def verify(self, password: str, hashed: str) -> bool:
+        if self.executor is None:
+            return verify_password(password, hashed, self.params)
+        return await asyncio.get_event_loop().run_in_executor(
+            self.executor, verify_password, password, hashed, self.params
+        )
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+
+
+def get_password_hasher(request: Request) -> PasswordHasher:
+    """
+    Password hasher of the app serving the request.
+    To be used as a dependency.
+    """
+    return request.app.state.password_hasher
@@ -0,0 +1,155 @@
+import codecs
+import json
+from typing import Any, AsyncIterator, Iterator, Optional, Tuple
+
+WHITESPACE = " \t\r\n"
+DELIMITERS = WHITESPACE + ",]"
+
+
+async def iter_json_records(
+    chunks: AsyncIterator[bytes], max_record_size: int = 1_048_576
+) -> AsyncIterator[Tuple[Optional[Any], Optional[str]]]:
+    """
+    Parse a request body while it is received and yield its records
+    one at a time as (record, error) pairs.
+
+    The body is either a JSON array or NDJSON (one record per line).
+    A NDJSON line that is not valid JSON yields an error for that
+    record only. A malformed JSON array can not be recovered from
+    and raises ValueError, as does a record longer than
+    `max_record_size` characters.
+    """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder("utf-8")()
+    array: Optional[ArrayParser] = None
+    is_array = None
+    # The line of a NDJSON body that is not complete yet
+    buffer = ""
+
+    async for chunk in chunks:
+        text = utf8.decode(chunk)
+        if is_array is None:
+            text = text.lstrip(WHITESPACE)
+            if not text:
+                continue
+            is_array = text[0] == "["
+            if is_array:
+                array = ArrayParser(decoder, max_record_size)
+                text = text[1:]
+
+        if array is not None:
+            for record in array.feed(text):
+                yield record, None
+        else:
+            *lines, buffer = (buffer + text).split("\n")
+            for line in lines:
+                if line.strip(WHITESPACE):
+                    yield _decode_line(decoder, line)
+            if len(buffer) > max_record_size:
+                raise ValueError(
+                    f"Record longer than {max_record_size} characters"
+                )
+
+    text = utf8.decode(b"", final=True)
+    if array is not None:
+        for record in array.feed(text, final=True):
+            yield record, None
+    elif (buffer + text).strip(WHITESPACE):
+        yield _decode_line(decoder, buffer + text)
+
+
+class ArrayParser:
+    """
+    Takes the complete records off the front of a JSON array body as
+    it is received, the opening bracket already taken. Raises
+    ValueError as soon as the array is malformed.
+    """
+
+    def __init__(self, decoder: json.JSONDecoder, max_record_size: int):
+        self.decoder = decoder
+        self.max_record_size = max_record_size
+        # What comes next: "first" a record or "]",
+        # "record" a record, "separator" a "," or "]"
+        self.expect = "first"
+        self.closed = False
+        # The start of a record that is not complete yet
+        self.buffer = ""
+
+    def feed(self, text: str, final: bool = False) -> Iterator[Any]:
+        """
+        Yield the records completed by `text`. With `final` the body
+        ends with `text`, so the array must be closed.
+        """
+        buffer = self.buffer + text
+        pos = 0
+        while True:
+            while pos < len(buffer) and buffer[pos] in WHITESPACE:
+                pos += 1
+            if pos == len(buffer):
+                break
+            if self.closed:
+                raise ValueError("Data after the end of the JSON array")
+            char = buffer[pos]
+            if self.expect == "separator" or (
+                self.expect == "first" and char == "]"
+            ):
+                if char == ",":
+                    self.expect = "record"
+                elif char == "]":
+                    self.closed = True
+                else:
+                    raise ValueError(
+                        f"Malformed JSON array, expected ',' or ']' "
+                        f"instead of {char!r}"
+                    )
+                pos += 1
+                continue
+            decoded = self._decode(buffer, pos, final)
+            if decoded is None:
+                break
+            record, pos = decoded
+            yield record
+            self.expect = "separator"
+
+        self.buffer = buffer[pos:]
+        if len(self.buffer) > self.max_record_size:
+            raise ValueError(
+                f"Record longer than {self.max_record_size} characters"
+            )
+        if final and not self.closed:
+            raise ValueError("Malformed JSON array")
+
+    def _decode(
+        self, buffer: str, pos: int, final: bool
+    ) -> Optional[Tuple[Any, int]]:
+        """
+        The record starting at `pos` and where it ends,
+        none if it is not fully received yet
+        """
+        if buffer[pos] in '{["':
+            try:
+                return self.decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                if final:
+                    raise ValueError("Malformed JSON array")
+                return None
+        # A number or literal ends at a separator. Without one it may
+        # continue in the next chunk, "2" of "2.5" is not a record yet.
+        end = pos
+        while end < len(buffer) and buffer[end] not in DELIMITERS:
+            end += 1
+        if end == len(buffer) and not final:
+            return None
+        try:
+            return self.decoder.decode(buffer[pos:end]), end
+        except json.JSONDecodeError:
+            raise ValueError("Malformed JSON array")
+
+
+def _decode_line(
+    decoder: json.JSONDecoder, line: str
+) -> Tuple[Optional[Any], Optional[str]]:
+    try:
+        return decoder.decode(line), None
+    except json.JSONDecodeError as e:
+        return None, str(e)
@@ -0,0 +1,173 @@
+import asyncio
+import logging
+import sys
+import time
+from typing import List, Set
+
+from bson import ObjectId
+from core.metrics import (
+    AVAILABILITY_INDEX_BOOKS,
+    AVAILABILITY_INDEX_BYTES,
+    AVAILABILITY_INDEX_LAG,
+)
+from motor.motor_asyncio import AsyncIOMotorCollection
+from pymongo.errors import PyMongoError
+
+logger = logging.getLogger(__name__)
+
+# Size of one ObjectId in the index, 12 bytes plus the bytes object
+ENTRY_SIZE = sys.getsizeof(ObjectId().binary)
+# Seconds between two updates of the metrics of the index
+REPORT_INTERVAL = 1.0
+
+
+class AvailabilityIndex:
+    """
+    In memory set of the books that are checked out, kept current from
+    a change stream on the books collection. Change streams need a
+    replica set, a single node one is enough.
+
+    The index lags behind the collection, so it is only good to skip
+    books that are most likely taken. Checkouts still write with a
+    conditional update, which decides who gets a book. Its lag is the
+    time since it was last known to be current, so it keeps growing
+    while the stream is stalled or retried.
+    """
+
+    def __init__(self, collection: AsyncIOMotorCollection, retry: float):
+        self.collection = collection
+        self.retry = retry
+        self.ready = False
+        # Time up to which every change has been applied
+        self._current_at = time.time()
+        self._checked_out: Set[bytes] = set()
+        self._tasks: List[asyncio.Future] = []
+
+    @property
+    def lag(self) -> float:
+        return max(0.0, time.time() - self._current_at)
+
+    def start(self):
+        """
+        Load the index and follow the change stream in the background
+        """
+        if not self._tasks:
+            self._current_at = time.time()
+            self._tasks = [
+                asyncio.ensure_future(self._run()),
+                asyncio.ensure_future(self._report_every(REPORT_INTERVAL)),
+            ]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self.ready = False
+
+    def filter_available(self, oids: List[ObjectId]) -> List[ObjectId]:
+        """
+        The ObjectIds in `oids` that are not known to be checked out.
+        All of them while the index is not loaded.
+        """
+        if not self.ready:
+            return oids
+        return [oid for oid in oids if oid.binary not in self._checked_out]
+
+    def stats(self) -> dict:
+        return {
+            "ready": self.ready,
+            "checked_out": len(self._checked_out),
+            "lag_seconds": self.lag,
+            "memory_bytes": self.memory(),
+        }
+
+    def memory(self) -> int:
+        """
+        Approximate bytes held by the index
+        """
+        return (
+            sys.getsizeof(self._checked_out)
+            + len(self._checked_out) * ENTRY_SIZE
+        )
+
+    async def _run(self):
+        while True:
+            try:
+                await self._follow()
+            except PyMongoError as e:
+                logger.warning(
+                    "Availability index stopped, retrying in %ss: %s",
+                    self.retry,
+                    e,
+                )
+            except Exception:
+                # Checkouts query every book until the index is back
+                logger.exception(
+                    "Availability index failed, retrying in %ss", self.retry
+                )
+            self.ready = False
+            await asyncio.sleep(self.retry)
+
+    async def _report_every(self, interval: float):
+        while True:
+            self._report()
+            await asyncio.sleep(interval)
+
+    async def _follow(self):
+        # The stream is opened before the books are read, so no change
+        # is missed. Changes from before the read are applied again on
+        # top of it, in order, which ends in the same state.
+        async with self.collection.watch() as stream:
+            cursor = self.collection.find(
+                {"checked_out_by": {"$ne": None}}, {"_id": 1}
+            )
+            loaded_at = time.time()
+            self._checked_out = {doc["_id"].binary async for doc in cursor}
+            self._current_at = loaded_at
+            self.ready = True
+            self._report()
+            logger.info(
+                "Availability index loaded, %d books are checked out",
+                len(self._checked_out),
+            )
+            while stream.alive:
+                waited_at = time.time()
+                change = await stream.try_next()
+                if change is None:
+                    # Nothing changed since the wait began
+                    self._current_at = waited_at
+                    continue
+                self._apply(change)
+                if "clusterTime" in change:
+                    self._current_at = change["clusterTime"].time
+        # The collection was dropped or renamed
+        logger.warning("Availability index stream was invalidated")
+
+    def _apply(self, change: dict):
+        operation = change["operationType"]
+        if operation == "delete":
+            self._checked_out.discard(change["documentKey"]["_id"].binary)
+            return
+        if operation in ("insert", "replace"):
+            document = change["fullDocument"]
+        elif operation == "update":
+            description = change["updateDescription"]
+            document = description["updatedFields"]
+            if "checked_out_by" not in document:
+                if "checked_out_by" not in description["removedFields"]:
+                    return
+                document = {}
+        else:
+            return
+
+        oid = change["documentKey"]["_id"].binary
+        if document.get("checked_out_by") is None:
+            self._checked_out.discard(oid)
+        else:
+            self._checked_out.add(oid)
+
+    def _report(self):
+        AVAILABILITY_INDEX_LAG.set(self.lag)
+        AVAILABILITY_INDEX_BOOKS.set(len(self._checked_out))
+        AVAILABILITY_INDEX_BYTES.set(self.memory())
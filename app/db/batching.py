@@ -0,0 +1,126 @@
+import asyncio
+from collections import defaultdict
+from typing import Dict, List, Optional, Set, Tuple
+
+from bson import ObjectId
+from db.crud import CrudService
+from db.stats import LoanStats
+
+# user id, book ids and the future the caller waits on
+Checkout = Tuple[ObjectId, List[ObjectId], asyncio.Future]
+
+
+class CheckoutBatcher:
+    """
+    Merges concurrent small checkouts into batches. A batch is written
+    once it holds `max_items` books or `max_delay` seconds after its
+    first checkout, whichever comes first, with one find and one bulk
+    write for all of its checkouts. Within a batch a book asked for by
+    several checkouts goes to the one that came first.
+    """
+
+    def __init__(
+        self,
+        book_service: CrudService,
+        loan_stats: LoanStats,
+        max_items: int,
+        max_delay: float,
+    ):
+        self.book_service = book_service
+        self.loan_stats = loan_stats
+        self.max_items = max_items
+        self.max_delay = max_delay
+        self._pending: List[Checkout] = []
+        self._pending_items = 0
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._flushes: Set[asyncio.Future] = set()
+
+    async def checkout(
+        self, user_id: ObjectId, oids: List[ObjectId]
+    ) -> Set[ObjectId]:
+        """
+        Checkout the books `oids` for the user with the next batch.
+        Return the ObjectIds of the books that were checked out.
+        """
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        self._pending.append((user_id, oids, future))
+        self._pending_items += len(oids)
+        if self._pending_items >= self.max_items:
+            self.flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_delay, self.flush)
+        return await future
+
+    def flush(self):
+        """
+        Start writing the pending checkouts as a batch
+        """
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending:
+            return
+        batch, self._pending, self._pending_items = self._pending, [], 0
+        task = asyncio.ensure_future(self._run(batch))
+        self._flushes.add(task)
+        task.add_done_callback(self._flushes.discard)
+
+    async def close(self):
+        """
+        Write the pending checkouts and wait for every batch to finish
+        """
+        self.flush()
+        if self._flushes:
+            await asyncio.gather(*self._flushes, return_exceptions=True)
+
+    async def _run(self, batch: List[Checkout]):
+        try:
+            results = await self._checkout(batch)
+        except Exception as e:
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, _, future), processed in zip(batch, results):
+            # The caller may have gone away in the meantime
+            if not future.done():
+                future.set_result(processed)
+
+    async def _checkout(self, batch: List[Checkout]) -> List[Set[ObjectId]]:
+        # First come first served, a book is claimed by the first
+        # checkout of the batch that asks for it
+        claims: Dict[ObjectId, int] = {}
+        for i, (_, oids, _) in enumerate(batch):
+            for oid in oids:
+                claims.setdefault(oid, i)
+
+        # Authors come along for the loan counters
+        available = await self.book_service.find_values(
+            {"_id": {"$in": list(claims)}, "checked_out_by": None}, "author"
+        )
+        claimed: Dict[int, List[ObjectId]] = defaultdict(list)
+        for oid in available:
+            claimed[claims[oid]].append(oid)
+
+        owners = {i: batch[i][0] for i in claimed}
+        modified = await self.book_service.bulk_update_by_ids(
+            [
+                (oids, {"checked_out_by": None}, {"checked_out_by": owners[i]})
+                for i, oids in claimed.items()
+            ]
+        )
+        if modified != len(available):
+            # Some books were taken in between, ask which ones we got
+            owned = [
+                {"_id": {"$in": oids}, "checked_out_by": owners[i]}
+                for i, oids in claimed.items()
+            ]
+            got = set(await self.book_service.find_ids({"$or": owned}))
+            for oids in claimed.values():
+                oids[:] = [oid for oid in oids if oid in got]
+
+        await self.loan_stats.checked_out(
+            [(owners[i], oids) for i, oids in claimed.items()], available
+        )
+        return [set(claimed.get(i, ())) for i in range(len(batch))]
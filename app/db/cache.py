@@ -0,0 +1,101 @@
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional, Tuple
+
+from core.metrics import MODEL_CACHE_ENTRIES, MODEL_CACHE_LOOKUPS
+
+
+class ModelCache:
+    """
+    In-process LRU cache where every entry lives for `ttl` seconds.
+
+    Used by the crud service to skip the database on hot lookups.
+    Writes that go around the service (celery tasks, other processes)
+    are not seen, so `ttl` bounds how stale an entry can get.
+    Lookups and the number of entries are exported as metrics,
+    labelled with `name`.
+    """
+
+    def __init__(self, maxsize: int, ttl: float, name: str):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[Hashable, Tuple[float, Any]]" = (
+            OrderedDict()
+        )
+        # Generation of the latest read in flight of each key
+        self._reads: Dict[Hashable, int] = {}
+        self._generation = 0
+        self._hit_metric = MODEL_CACHE_LOOKUPS.labels(name, "hit")
+        self._miss_metric = MODEL_CACHE_LOOKUPS.labels(name, "miss")
+        self._entries_metric = MODEL_CACHE_ENTRIES.labels(name)
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """
+        Return the cached value if it is still fresh else none
+        """
+        entry = self._entries.get(key)
+        if entry is not None:
+            expires, value = entry
+            if expires > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                self._hit_metric.inc()
+                return value
+            del self._entries[key]
+        self.misses += 1
+        self._miss_metric.inc()
+        return None
+
+    def start_read(self, key: Hashable) -> int:
+        """
+        To be called before reading the value of `key` from the database.
+        Returns the generation to pass to `set` with what was read.
+        Invalidating the key meanwhile makes `set` drop the value,
+        as it may be from before the write.
+        """
+        self._generation += 1
+        self._reads[key] = self._generation
+        return self._generation
+
+    def end_read(self, key: Hashable, generation: int):
+        """
+        To be called once the read of `start_read` is done, stored or not
+        """
+        if self._reads.get(key) == generation:
+            del self._reads[key]
+
+    def set(self, key: Hashable, value: Any, generation: Optional[int] = None):
+        """
+        Store the value, evicting the least recently used entries
+        when the cache is full. With the `generation` of a read, the
+        value is only stored if the key was not invalidated since.
+        """
+        if generation is not None and self._reads.get(key) != generation:
+            return
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+        self._entries_metric.set(len(self._entries))
+
+    def invalidate(self, *keys: Hashable):
+        for key in keys:
+            self._entries.pop(key, None)
+            self._reads.pop(key, None)
+        self._entries_metric.set(len(self._entries))
+
+    def clear(self):
+        self._entries.clear()
+        self._reads.clear()
+        self._entries_metric.set(0)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+        }
@@ -1,8 +1,19 @@
-from typing import Optional, Type, TypeVar
+import asyncio
+from typing import (
+    Any,
+    AsyncIterator,
+    Dict,
+    List,
+    Optional,
+    Tuple,
+    Type,
+    TypeVar,
+)
 
 from bson import ObjectId
+from db.cache import ModelCache
+from db.engines import StorageEngine
 from models.pyobjectid import MongoModel
-from motor.motor_asyncio import AsyncIOMotorCollection
 from pydantic import BaseModel
 
 M = TypeVar("M", bound=MongoModel)
@@ -12,11 +23,17 @@ class CrudService(BaseModel):
     """
     Generic crud service
 
-    Takes a collection to operate on and a model to operate with.
+    Takes a storage engine to operate on and a model to operate with.
+    If a cache is given, models found by id are served from it
+    until they are changed through the service or expire.
+    Without `validate_reads` models read from the engine
+    are built without running validation.
     """
 
-    collection: AsyncIOMotorCollection
+    engine: StorageEngine
     model_cls: Type[MongoModel]
+    cache: Optional[ModelCache] = None
+    validate_reads: bool = True
 
     class Config:
         arbitrary_types_allowed = True
@@ -26,46 +43,241 @@ class CrudService(BaseModel):
         Try to create a model in models collection.
         If creation is failed return none instead
         """
-        created = await self.collection.insert_one(model.dict(by_alias=True))
-        if created.acknowledged and created.inserted_id == model.id:
+        if await self.engine.insert_one(model.dict(by_alias=True)):
             return model
         else:
             return None
 
+    async def create_models(self, models: List[M]) -> Tuple[int, List[dict]]:
+        """
+        Insert many models at once without stopping at the first error.
+        Return the number of inserted models and the write errors,
+        whose `index` is the position of the model in `models`.
+        """
+        return await self.engine.insert_many(
+            [model.dict(by_alias=True) for model in models]
+        )
+
     async def find_model_by_id(self, oid: ObjectId) -> Optional[MongoModel]:
         """
         Try to match `oid` with ObjectId in models collection,
         if found return the model as M
         else return none.
         """
-        model = await self.collection.find_one({"_id": oid})
-        if model:
-            return self.model_cls(**model)
-        return None
+        if self.cache is None:
+            model = await self.engine.find_one(oid)
+            return self.to_model(model) if model else None
+
+        cached = self.cache.get(oid)
+        if cached is not None:
+            # Callers may change the model, never hand out the cached one
+            return cached.copy()
+
+        # A write through the service while the read is in flight
+        # invalidates the key, what was read is not cached then
+        generation = self.cache.start_read(oid)
+        try:
+            model = await self.engine.find_one(oid)
+            if model:
+                found = self.to_model(model)
+                self.cache.set(oid, found.copy(), generation)
+                return found
+            return None
+        finally:
+            self.cache.end_read(oid, generation)
+
+    async def find_by_ids(
+        self, oids: List[ObjectId], chunk_size: int
+    ) -> AsyncIterator[dict]:
+        """
+        Yield the raw documents whose ObjectId is in `oids`.
+        Ids are queried `chunk_size` at a time with `$in`, documents are
+        yielded as the cursor produces them.
+        """
+        for i in range(0, len(oids), chunk_size):
+            docs = self.engine.find(
+                {"_id": {"$in": oids[i : i + chunk_size]}},
+                batch_size=chunk_size,
+            )
+            async for doc in docs:
+                yield doc
+
+    async def find_all(
+        self, query: dict, projection: Optional[dict], batch_size: int
+    ) -> AsyncIterator[dict]:
+        """
+        Yield the raw documents matching `query` in no particular order,
+        fetched from the engine `batch_size` at a time
+        """
+        async for doc in self.engine.find(
+            query, projection, batch_size=batch_size
+        ):
+            yield doc
+
+    async def find_page(
+        self,
+        query: dict,
+        after: Optional[ObjectId],
+        limit: int,
+        projection: Optional[dict] = None,
+    ) -> Tuple[List[dict], Optional[ObjectId]]:
+        """
+        Keyset pagination on `_id`. Return up to `limit` raw documents
+        matching `query` whose ObjectId is greater than `after`, and the
+        ObjectId to continue from if there are more documents.
+        """
+        if after is not None:
+            query = {**query, "_id": {"$gt": after}}
+        docs = [
+            doc
+            async for doc in self.engine.find(
+                query, projection, sort_by_id=True, limit=limit + 1
+            )
+        ]
+        if len(docs) > limit:
+            return docs[:limit], docs[limit - 1]["_id"]
+        return docs, None
+
+    async def find_ids(self, query: dict) -> List[ObjectId]:
+        """
+        Return the ObjectIds of the models matching `query`
+        """
+        docs = self.engine.find(query, {"_id": 1})
+        return [doc["_id"] async for doc in docs]
+
+    async def find_values(
+        self, query: dict, field: str
+    ) -> Dict[ObjectId, Any]:
+        """
+        Return `field` of the models matching `query`, by ObjectId
+        """
+        docs = self.engine.find(query, {field: 1})
+        return {doc["_id"]: doc.get(field) async for doc in docs}
+
+    async def find_values_chunked(
+        self,
+        oids: List[ObjectId],
+        query: dict,
+        field: str,
+        chunk_size: int,
+        concurrency: int,
+    ) -> AsyncIterator[Dict[ObjectId, Any]]:
+        """
+        Like `find_values` for the models with ObjectId in `oids` that
+        also match `query`. Ids are queried `chunk_size` at a time, with
+        up to `concurrency` queries running at once. The found values of
+        each chunk are yielded as soon as its query is done.
+        """
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def find(chunk: List[ObjectId]) -> Dict[ObjectId, Any]:
+            async with semaphore:
+                return await self.find_values(
+                    {**query, "_id": {"$in": chunk}}, field
+                )
 
-    async def update_model(self, oid: ObjectId, model_update: M) -> Optional[M]:
+        tasks = [
+            asyncio.ensure_future(find(oids[i : i + chunk_size]))
+            for i in range(0, len(oids), chunk_size)
+        ]
+        try:
+            for task in asyncio.as_completed(tasks):
+                yield await task
+        finally:
+            # The caller stopped early or a query failed
+            for task in tasks:
+                task.cancel()
+
+    async def update_model(
+        self, oid: ObjectId, model_update: M
+    ) -> Optional[M]:
         """
         Try to replace the entire object with the new object
         If the operation is acknowledged by the db return the model
         else return none
         """
-        ok = await self.collection.replace_one(
-            {"_id": oid}, replacement=model_update.dict(by_alias=True)
+        ok = await self.engine.replace_one(
+            oid, model_update.dict(by_alias=True)
         )
-        if ok.acknowledged:
+        self.invalidate(oid)
+        if ok:
             return model_update
         else:
             return None
 
-    async def remove_model(self, oid: ObjectId) -> bool:
+    async def patch_model(
+        self, oid: ObjectId, changes: dict
+    ) -> Optional[MongoModel]:
+        """
+        Set only the fields in `changes` in a single round trip.
+        If the model is found return it as it is after the update
+        else return none
+        """
+        if not changes:
+            return await self.find_model_by_id(oid)
+        updated = await self.engine.update_one(oid, changes)
+        self.invalidate(oid)
+        if updated:
+            return self.to_model(updated)
+        return None
+
+    async def update_many_by_ids(
+        self, oids: List[ObjectId], condition: dict, changes: dict
+    ) -> int:
+        """
+        Set the fields in `changes` on the models with ObjectId in `oids`
+        that also match `condition`, with a single update.
+        Return the number of models that were modified.
+        """
+        modified = await self.engine.bulk_update(
+            [({"_id": {"$in": oids}, **condition}, changes)]
+        )
+        self.invalidate(*oids)
+        return modified
+
+    async def bulk_update_by_ids(
+        self, updates: List[Tuple[List[ObjectId], dict, dict]]
+    ) -> int:
+        """
+        Like `update_many_by_ids` for many `(oids, condition, changes)`
+        at once, sent as a single unordered bulk write.
+        Return the number of models that were modified.
+        """
+        if not updates:
+            return 0
+        modified = await self.engine.bulk_update(
+            [
+                ({"_id": {"$in": oids}, **condition}, changes)
+                for oids, condition, changes in updates
+            ]
+        )
+        self.invalidate(*(oid for oids, _, _ in updates for oid in oids))
+        return modified
+
+    async def remove_model(self, oid: ObjectId) -> Optional[MongoModel]:
         """
         Try to delete the model with given oid
-        If the operation is acknowledged and a deletion operation has occured
-        return the True
-        else return False
+        If a model was deleted return it
+        else return none
         """
-        ok = await self.collection.delete_one({"_id": oid})
-        if ok.acknowledged and ok.deleted_count == 1:
-            return True
-        else:
-            return False
+        deleted = await self.engine.delete_one(oid)
+        self.invalidate(oid)
+        if deleted:
+            return self.to_model(deleted)
+        return None
+
+    def to_model(self, doc: dict) -> MongoModel:
+        """
+        Turn a raw document of the engine into a model
+        """
+        if self.validate_reads:
+            return self.model_cls(**doc)
+        return self.model_cls.from_mongo(doc)
+
+    def invalidate(self, *oids: ObjectId):
+        """
+        Drop the cached models of `oids`.
+        To be called after writing around the service.
+        """
+        if self.cache is not None:
+            self.cache.invalidate(*oids)
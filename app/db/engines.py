@@ -0,0 +1,493 @@
+from abc import ABC, abstractmethod
+from bisect import bisect_left, bisect_right, insort
+from typing import (
+    Any,
+    AsyncIterator,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Set,
+    Tuple,
+)
+
+from bson import ObjectId
+from motor.motor_asyncio import AsyncIOMotorCollection
+from pymongo import IndexModel, ReturnDocument, UpdateMany, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+# Error code of mongo for duplicate keys
+DUPLICATE_KEY = 11000
+
+
+class StorageEngine(ABC):
+    """
+    Storage of the documents of one collection, as used by `CrudService`.
+    Queries are mongo queries. Changes are the fields to `$set`.
+    """
+
+    @abstractmethod
+    async def find_one(self, oid: ObjectId) -> Optional[dict]:
+        """
+        The document with ObjectId `oid`, none if there is none
+        """
+
+    @abstractmethod
+    def find(
+        self,
+        query: dict,
+        projection: Optional[dict] = None,
+        sort_by_id: bool = False,
+        limit: int = 0,
+        batch_size: int = 0,
+    ) -> AsyncIterator[dict]:
+        """
+        Iterate over the documents matching `query`
+        """
+
+    @abstractmethod
+    async def insert_one(self, doc: dict) -> bool:
+        """
+        Raise DuplicateKeyError if a unique key is taken
+        """
+
+    @abstractmethod
+    async def insert_many(self, docs: List[dict]) -> Tuple[int, List[dict]]:
+        """
+        Insert what can be inserted. Return the number of inserted
+        documents and the errors as mongo write errors, whose `index`
+        is the position of the document in `docs`.
+        """
+
+    @abstractmethod
+    async def replace_one(self, oid: ObjectId, doc: dict) -> bool:
+        """
+        Return whether the write went through
+        """
+
+    @abstractmethod
+    async def update_one(self, oid: ObjectId, changes: dict) -> Optional[dict]:
+        """
+        Return the document as it is after the update, none if not found
+        """
+
+    @abstractmethod
+    async def bulk_update(self, updates: List[Tuple[dict, dict]]) -> int:
+        """
+        Apply every `(query, changes)` to all documents matching `query`.
+        Return the number of documents that were modified.
+        """
+
+    @abstractmethod
+    async def delete_one(self, oid: ObjectId) -> Optional[dict]:
+        """
+        Return the deleted document, none if there was none
+        """
+
+    @abstractmethod
+    async def increment(self, field: str, amounts: Dict[Any, int]):
+        """
+        Add each amount to `field` of the document with that `_id`,
+        creating documents that do not exist yet
+        """
+
+
+class MotorEngine(StorageEngine):
+    """
+    Documents of a mongo collection
+    """
+
+    def __init__(self, collection: AsyncIOMotorCollection):
+        self.collection = collection
+
+    async def find_one(self, oid: ObjectId) -> Optional[dict]:
+        return await self.collection.find_one({"_id": oid})
+
+    async def find(
+        self,
+        query: dict,
+        projection: Optional[dict] = None,
+        sort_by_id: bool = False,
+        limit: int = 0,
+        batch_size: int = 0,
+    ) -> AsyncIterator[dict]:
+        cursor = self.collection.find(
+            query, projection, limit=limit, batch_size=batch_size
+        )
+        if sort_by_id:
+            cursor = cursor.sort("_id", 1)
+        async for doc in cursor:
+            yield doc
+
+    async def insert_one(self, doc: dict) -> bool:
+        created = await self.collection.insert_one(doc)
+        return created.acknowledged and created.inserted_id == doc["_id"]
+
+    async def insert_many(self, docs: List[dict]) -> Tuple[int, List[dict]]:
+        try:
+            created = await self.collection.insert_many(docs, ordered=False)
+            return len(created.inserted_ids), []
+        except BulkWriteError as e:
+            return e.details["nInserted"], e.details["writeErrors"]
+
+    async def replace_one(self, oid: ObjectId, doc: dict) -> bool:
+        ok = await self.collection.replace_one({"_id": oid}, doc)
+        return ok.acknowledged
+
+    async def update_one(self, oid: ObjectId, changes: dict) -> Optional[dict]:
+        return await self.collection.find_one_and_update(
+            {"_id": oid},
+            {"$set": changes},
+            return_document=ReturnDocument.AFTER,
+        )
+
+    async def bulk_update(self, updates: List[Tuple[dict, dict]]) -> int:
+        if len(updates) == 1:
+            query, changes = updates[0]
+            updated = await self.collection.update_many(
+                query, {"$set": changes}
+            )
+            return updated.modified_count
+        result = await self.collection.bulk_write(
+            [
+                UpdateMany(query, {"$set": changes})
+                for query, changes in updates
+            ],
+            ordered=False,
+        )
+        return result.modified_count
+
+    async def delete_one(self, oid: ObjectId) -> Optional[dict]:
+        return await self.collection.find_one_and_delete({"_id": oid})
+
+    async def increment(self, field: str, amounts: Dict[Any, int]):
+        if amounts:
+            await self.collection.bulk_write(
+                [
+                    UpdateOne({"_id": key}, {"$inc": {field: n}}, upsert=True)
+                    for key, n in amounts.items()
+                ],
+                ordered=False,
+            )
+
+
+class MemoryEngine(StorageEngine):
+    """
+    Documents in a dict of this process, with secondary indexes on the
+    first field of each of `indexes`. Supports the queries the app
+    makes: equality, `$eq`, `$ne`, `$in`, `$gt`, `$gte`, `$lt`, `$lte`,
+    `$and` and `$or`. The ObjectIds are also kept sorted, so pages in
+    `_id` order start where the previous one ended. Operations never
+    wait, so each one is atomic.
+    Meant for tests and for load testing the app without a database.
+    """
+
+    def __init__(self, indexes: Iterable[IndexModel] = ()):
+        self._docs: Dict[ObjectId, dict] = {}
+        self._ids: List[ObjectId] = []
+        # field -> value -> ObjectIds of the documents with that value
+        self._indexes: Dict[str, Dict[Any, Set[ObjectId]]] = {}
+        self._unique: Set[str] = set()
+        for index in indexes:
+            field = next(iter(index.document["key"]))
+            self._indexes[field] = {}
+            if index.document.get("unique"):
+                self._unique.add(field)
+
+    async def find_one(self, oid: ObjectId) -> Optional[dict]:
+        doc = self._docs.get(oid)
+        return dict(doc) if doc is not None else None
+
+    async def find(
+        self,
+        query: dict,
+        projection: Optional[dict] = None,
+        sort_by_id: bool = False,
+        limit: int = 0,
+        batch_size: int = 0,
+    ) -> AsyncIterator[dict]:
+        for oid in self._match(query, sort_by_id, limit):
+            # Deleted while the caller was busy with earlier documents
+            doc = self._docs.get(oid)
+            if doc is not None:
+                yield project(doc, projection)
+
+    async def insert_one(self, doc: dict) -> bool:
+        taken = self._taken_key(doc)
+        if taken:
+            raise DuplicateKeyError(taken, DUPLICATE_KEY)
+        self._add(dict(doc))
+        return True
+
+    async def insert_many(self, docs: List[dict]) -> Tuple[int, List[dict]]:
+        errors = []
+        for i, doc in enumerate(docs):
+            taken = self._taken_key(doc)
+            if taken:
+                errors.append(
+                    {"index": i, "code": DUPLICATE_KEY, "errmsg": taken}
+                )
+            else:
+                self._add(dict(doc))
+        return len(docs) - len(errors), errors
+
+    async def replace_one(self, oid: ObjectId, doc: dict) -> bool:
+        old = self._docs.get(oid)
+        if old is not None:
+            self._check_unique(oid, doc)
+            self._unindex(old)
+            new = {**doc, "_id": oid}
+            self._docs[oid] = new
+            self._index(new)
+        return True
+
+    async def update_one(self, oid: ObjectId, changes: dict) -> Optional[dict]:
+        doc = self._docs.get(oid)
+        if doc is None:
+            return None
+        self._check_unique(oid, changes)
+        self._set(doc, changes)
+        return dict(doc)
+
+    async def bulk_update(self, updates: List[Tuple[dict, dict]]) -> int:
+        modified = 0
+        for query, changes in updates:
+            for oid in self._match(query):
+                doc = self._docs[oid]
+                if any(doc.get(k) != v for k, v in changes.items()):
+                    self._set(doc, changes)
+                    modified += 1
+        return modified
+
+    async def delete_one(self, oid: ObjectId) -> Optional[dict]:
+        doc = self._docs.get(oid)
+        if doc is not None:
+            self._remove(doc)
+        return doc
+
+    async def increment(self, field: str, amounts: Dict[Any, int]):
+        for key, n in amounts.items():
+            doc = self._docs.get(key)
+            if doc is None:
+                self._add({"_id": key, field: n})
+            else:
+                self._set(doc, {field: doc.get(field, 0) + n})
+
+    def _match(
+        self, query: dict, sort_by_id: bool = False, limit: int = 0
+    ) -> List[ObjectId]:
+        candidates = self._candidates(query)
+        if sort_by_id:
+            candidates = self._in_order(candidates, query)
+        elif candidates is None:
+            candidates = self._docs
+        compiled = compile_query(query)
+        found = []
+        for oid in candidates:
+            doc = self._docs.get(oid)
+            if doc is not None and matches(doc, compiled):
+                found.append(oid)
+                if len(found) == limit:
+                    break
+        return found
+
+    def _in_order(
+        self, candidates: Optional[Iterable[ObjectId]], query: dict
+    ) -> Iterable[ObjectId]:
+        """
+        `candidates` sorted, all ObjectIds if none. All ObjectIds are
+        walked from the lower bound of `_id` in `query`.
+        """
+        if candidates is not None:
+            return sorted(candidates)
+        ids = self._ids
+        start = 0
+        cond = query.get("_id")
+        if isinstance(cond, dict):
+            if "$gt" in cond:
+                start = bisect_right(ids, cond["$gt"])
+            elif "$gte" in cond:
+                start = bisect_left(ids, cond["$gte"])
+        return (ids[i] for i in range(start, len(ids)))
+
+    def _candidates(self, query: dict) -> Optional[Iterable[ObjectId]]:
+        """
+        ObjectIds of a superset of the documents matching `query`,
+        narrowed by `_id` or an indexed field where the query allows.
+        None if every document is a candidate.
+        """
+        clauses = list(query.items())
+        for key, cond in query.items():
+            if key == "$and":
+                clauses += [c for q in cond for c in q.items()]
+        for key, cond in clauses:
+            if key == "_id":
+                values = self._values(cond)
+                if values is not None:
+                    return list(dict.fromkeys(values))
+            elif key in self._indexes:
+                values = self._values(cond)
+                if values is not None:
+                    index = self._indexes[key]
+                    found: Set[ObjectId] = set()
+                    for value in values:
+                        found |= index.get(value, set())
+                    return found
+        return None
+
+    @staticmethod
+    def _values(cond: Any) -> Optional[list]:
+        """
+        The values a field may have under `cond`, none if too many
+        """
+        if not isinstance(cond, dict):
+            return [cond]
+        if cond.keys() == {"$in"}:
+            return list(cond["$in"])
+        if cond.keys() == {"$eq"}:
+            return [cond["$eq"]]
+        return None
+
+    def _taken_key(self, doc: dict) -> Optional[str]:
+        """
+        Error message if `doc` has an `_id` or unique value that is taken
+        """
+        if doc["_id"] in self._docs:
+            return (
+                f"E11000 duplicate key error dup key: {{ _id: {doc['_id']} }}"
+            )
+        for field in self._unique:
+            if self._indexes[field].get(doc.get(field)):
+                return f"E11000 duplicate key error dup key: {{ {field} }}"
+        return None
+
+    def _check_unique(self, oid: ObjectId, fields: dict):
+        """
+        Raise DuplicateKeyError if another document has a unique value
+        of `fields`
+        """
+        for field in self._unique & fields.keys():
+            if self._indexes[field].get(fields[field], set()) - {oid}:
+                raise DuplicateKeyError(
+                    f"E11000 duplicate key error dup key: {{ {field} }}",
+                    DUPLICATE_KEY,
+                )
+
+    def _add(self, doc: dict):
+        self._docs[doc["_id"]] = doc
+        # New ObjectIds are mostly the largest, then this appends
+        insort(self._ids, doc["_id"])
+        self._index(doc)
+
+    def _remove(self, doc: dict):
+        del self._docs[doc["_id"]]
+        del self._ids[bisect_left(self._ids, doc["_id"])]
+        self._unindex(doc)
+
+    def _index(self, doc: dict):
+        for field, index in self._indexes.items():
+            index.setdefault(doc.get(field), set()).add(doc["_id"])
+
+    def _unindex(self, doc: dict):
+        for field, index in self._indexes.items():
+            index.get(doc.get(field), set()).discard(doc["_id"])
+
+    def _set(self, doc: dict, changes: dict):
+        for field, value in changes.items():
+            index = self._indexes.get(field)
+            if index is not None:
+                index.get(doc.get(field), set()).discard(doc["_id"])
+                index.setdefault(value, set()).add(doc["_id"])
+            doc[field] = value
+
+
+class Membership:
+    """
+    Argument of `$in`, checked with a set lookup instead of a scan of
+    the list for every document. Unhashable values are still scanned.
+    """
+
+    def __init__(self, values: Iterable):
+        self.hashable: Set[Any] = set()
+        self.unhashable: List[Any] = []
+        for value in values:
+            try:
+                self.hashable.add(value)
+            except TypeError:
+                self.unhashable.append(value)
+
+    def __contains__(self, value: Any) -> bool:
+        try:
+            if value in self.hashable:
+                return True
+        except TypeError:
+            pass
+        return value in self.unhashable
+
+
+def compile_query(query: dict) -> dict:
+    """
+    `query` with the arguments of `$in` as `Membership`, to be matched
+    against many documents
+    """
+    compiled: Dict[str, Any] = {}
+    for key, cond in query.items():
+        if key in ("$and", "$or"):
+            compiled[key] = [compile_query(q) for q in cond]
+        elif isinstance(cond, dict) and "$in" in cond:
+            compiled[key] = {**cond, "$in": Membership(cond["$in"])}
+        else:
+            compiled[key] = cond
+    return compiled
+
+
+OPERATORS = {
+    "$eq": lambda value, arg: value == arg,
+    "$ne": lambda value, arg: value != arg,
+    "$in": lambda value, arg: value in arg,
+    "$gt": lambda value, arg: value is not None and value > arg,
+    "$gte": lambda value, arg: value is not None and value >= arg,
+    "$lt": lambda value, arg: value is not None and value < arg,
+    "$lte": lambda value, arg: value is not None and value <= arg,
+}
+
+
+def matches(doc: dict, query: dict) -> bool:
+    """
+    Whether `doc` matches the mongo query `query`.
+    Missing fields match none, like in mongo.
+    """
+    for key, cond in query.items():
+        if key == "$and":
+            if not all(matches(doc, q) for q in cond):
+                return False
+        elif key == "$or":
+            if not any(matches(doc, q) for q in cond):
+                return False
+        elif isinstance(cond, dict):
+            value = doc.get(key)
+            for op, arg in cond.items():
+                if op not in OPERATORS:
+                    raise ValueError(f"Unsupported query operator {op}")
+                if not OPERATORS[op](value, arg):
+                    return False
+        elif doc.get(key) != cond:
+            return False
+    return True
+
+
+def project(doc: dict, projection: Optional[dict]) -> dict:
+    """
+    Copy of `doc` with the fields of a mongo projection
+    """
+    if projection is None:
+        return dict(doc)
+    if not projection:
+        # Like pymongo, which asks for the _id only then
+        projection = {"_id": 1}
+    if any(projection.values()):
+        fields = {k for k, v in projection.items() if v}
+        if projection.get("_id", 1):
+            fields.add("_id")
+        return {k: v for k, v in doc.items() if k in fields}
+    return {k: v for k, v in doc.items() if k not in projection}
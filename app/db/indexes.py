@@ -0,0 +1,79 @@
+import logging
+from typing import Dict, List
+
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import ASCENDING, IndexModel
+from pymongo.errors import OperationFailure
+
+logger = logging.getLogger(__name__)
+
+# Indexes the app relies on, by collection
+INDEXES: Dict[str, List[IndexModel]] = {
+    "books": [
+        # Also sorts a users books by _id for paging
+        IndexModel(
+            [("checked_out_by", ASCENDING), ("_id", ASCENDING)],
+            name="checked_out_by",
+        ),
+        IndexModel([("isbn13", ASCENDING)], name="isbn13", unique=True),
+        # Also sorts the books of an author by _id for paging
+        IndexModel(
+            [("author", ASCENDING), ("_id", ASCENDING)], name="author_id"
+        ),
+    ],
+    "users": [
+        IndexModel([("email", ASCENDING)], name="email"),
+        IndexModel([("username", ASCENDING)], name="username"),
+    ],
+}
+
+# Indexes that were replaced, by collection. They are dropped on startup
+# once every index of the collection exists
+OBSOLETE_INDEXES: Dict[str, List[str]] = {
+    # Replaced by author_id
+    "books": ["author"],
+}
+
+
+async def ensure_indexes(db: AsyncIOMotorDatabase) -> List[str]:
+    """
+    Create the indexes in INDEXES that do not exist yet, then drop
+    the ones in OBSOLETE_INDEXES.
+    Indexes are created one by one so that one failing, e.g. unique
+    isbn13 over duplicate data, does not stop the others.
+    Return the indexes that are still missing as collection.name
+    """
+    missing = []
+    for collection_name, indexes in INDEXES.items():
+        collection = db[collection_name]
+        for index in indexes:
+            try:
+                await collection.create_indexes([index])
+            except OperationFailure as e:
+                logger.warning(
+                    "Could not create index %s.%s: %s",
+                    collection_name,
+                    index.document["name"],
+                    e,
+                )
+        existing = await collection.index_information()
+        absent = [
+            f"{collection_name}.{index.document['name']}"
+            for index in indexes
+            if index.document["name"] not in existing
+        ]
+        missing += absent
+        # Only once their replacements are built
+        if not absent:
+            for name in OBSOLETE_INDEXES.get(collection_name, []):
+                if name in existing:
+                    try:
+                        await collection.drop_index(name)
+                    except OperationFailure as e:
+                        logger.warning(
+                            "Could not drop index %s.%s: %s",
+                            collection_name,
+                            name,
+                            e,
+                        )
+    return missing
@@ -1,26 +1,133 @@
-from core import config
+from typing import Optional
+
+from core.config import Settings
+from db.availability import AvailabilityIndex
+from db.batching import CheckoutBatcher
+from db.cache import ModelCache
 from db.crud import CrudService
+from db.engines import MemoryEngine, MotorEngine, StorageEngine
+from db.indexes import INDEXES
+from db.stats import STATS_COLLECTION, LoanStats
+from fastapi import Request
 from models.book import BookModel
 from models.user import UserModel
-from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorCollection
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorDatabase
+
+
+class Database:
+    """
+    Motor client of an app and the services built on it.
+    Created once when the app starts, see `main.create_app`,
+    and shared by every request.
+    With the memory storage engine there is no client and `db` is none.
+    """
+
+    def __init__(self, settings: Settings):
+        self.client: Optional[AsyncIOMotorClient] = None
+        self.db: Optional[AsyncIOMotorDatabase] = None
+        if settings.storage_engine == "memory":
+            users: StorageEngine = MemoryEngine(INDEXES["users"])
+            books: StorageEngine = MemoryEngine(INDEXES["books"])
+            stats: StorageEngine = MemoryEngine()
+        else:
+            self.client = AsyncIOMotorClient(
+                settings.db_uri, **settings.client_options()
+            )
+            self.db = self.client.get_database(settings.db_name)
+            users = MotorEngine(self.db.users)
+            books = MotorEngine(self.db.books)
+            stats = MotorEngine(self.db[STATS_COLLECTION])
+
+        user_cache = book_cache = None
+        if settings.cache_enabled:
+            user_cache = ModelCache(
+                settings.cache_max_size, settings.user_cache_ttl, "users"
+            )
+            book_cache = ModelCache(
+                settings.cache_max_size, settings.book_cache_ttl, "books"
+            )
 
-settings = config.Settings()  # Settings read from .env
+        self.user_service = CrudService(
+            engine=users, model_cls=UserModel, cache=user_cache
+        )
+        self.book_service = CrudService(
+            engine=books, model_cls=BookModel, cache=book_cache
+        )
+        # Same books, but reads are not validated
+        self.book_reader = CrudService(
+            engine=books,
+            model_cls=BookModel,
+            cache=book_cache,
+            validate_reads=False,
+        )
+        self.loan_stats = LoanStats(stats)
+        self.checkout_batcher = CheckoutBatcher(
+            self.book_service,
+            self.loan_stats,
+            settings.checkout_batch_max_items,
+            settings.checkout_batch_max_delay_ms / 1000,
+        )
+        self.availability: Optional[AvailabilityIndex] = None
+        # The index follows a change stream, so it needs mongo
+        if settings.availability_index_enabled and self.db is not None:
+            self.availability = AvailabilityIndex(
+                self.db.books, settings.availability_index_retry
+            )
 
-client = AsyncIOMotorClient(settings.db_uri)
-db = client.get_database(settings.db_name)
-users_collection: AsyncIOMotorCollection = db.users
-books_collection: AsyncIOMotorCollection = db.books
+    async def close(self):
+        if self.availability is not None:
+            await self.availability.stop()
+        await self.checkout_batcher.close()
+        if self.client is not None:
+            self.client.close()
 
 
-def get_user_service() -> CrudService:
+def get_database(request: Request) -> Database:
+    """
+    Database of the app serving the request. To be used as a dependency.
+    """
+    return request.app.state.database
+
+
+def get_user_service(request: Request) -> CrudService:
     """
     User specific crud service. To be used as a dependency.
     """
-    return CrudService(collection=users_collection, model_cls=UserModel)
+    return get_database(request).user_service
 
 
-def get_book_service() -> CrudService:
+def get_book_service(request: Request) -> CrudService:
     """
     Book specific crud service. To be used as a dependency.
     """
-    return CrudService(collection=books_collection, model_cls=BookModel)
+    return get_database(request).book_service
+
+
+def get_book_reader(request: Request) -> CrudService:
+    """
+    Book specific crud service that does not validate what it reads.
+    To be used as a dependency on hot read paths.
+    """
+    return get_database(request).book_reader
+
+
+def get_availability_index(request: Request) -> Optional[AvailabilityIndex]:
+    """
+    Index of checked out books, none if it is turned off.
+    To be used as a dependency.
+    """
+    return get_database(request).availability
+
+
+def get_checkout_batcher(request: Request) -> CheckoutBatcher:
+    """
+    Batcher of small checkouts. To be used as a dependency.
+    """
+    return get_database(request).checkout_batcher
+
+
+def get_loan_stats(request: Request) -> LoanStats:
+    """
+    Counters of checked out books. To be used as a dependency.
+    """
+    return get_database(request).loan_stats
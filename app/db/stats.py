@@ -0,0 +1,142 @@
+import logging
+from collections import Counter
+from typing import Any, Dict, List, Optional, Tuple
+
+from bson import ObjectId
+from db.engines import StorageEngine
+from pymongo.collection import Collection
+from pymongo.errors import PyMongoError
+
+logger = logging.getLogger(__name__)
+
+# Counters live in the stats collection, one document per counter,
+# e.g. {"_id": "user:615019d8ab766b8cc37cebf7", "checked_out": 3}
+STATS_COLLECTION = "stats"
+FIELD = "checked_out"
+TOTAL = "total"
+
+# (user id, ObjectIds of the books) of some checkouts or returns
+Loans = List[Tuple[ObjectId, List[ObjectId]]]
+# Author of each of those books, by ObjectId
+Authors = Dict[ObjectId, Any]
+
+
+def user_key(user_id: ObjectId) -> str:
+    return f"user:{user_id}"
+
+
+def author_key(author: str) -> str:
+    return f"author:{author}"
+
+
+def increments(users: Counter, authors: Counter, sign: int) -> Dict[str, int]:
+    """
+    Amounts to add to the counters when the books counted by `users`
+    and `authors` are checked out (sign 1) or come back (sign -1)
+    """
+    amounts = {TOTAL: sign * sum(users.values())}
+    amounts.update({user_key(u): sign * n for u, n in users.items()})
+    amounts.update({author_key(a): sign * n for a, n in authors.items()})
+    return {key: n for key, n in amounts.items() if n}
+
+
+class LoanStats:
+    """
+    Number of checked out books in total, per user and per author.
+    Counters are updated where books are checked out, returned and
+    deleted, so reading one is a single lookup. Writes that go around
+    those paths (e.g. changing `checked_out_by` with a patch) make the
+    counters drift, `setup_case.py rebuild-stats` fixes that.
+    """
+
+    def __init__(self, engine: StorageEngine):
+        self.engine = engine
+
+    async def checked_out(self, loans: Loans, authors: Authors):
+        """
+        Count the books of each `(user_id, book oids)` as checked out.
+        `authors` holds the author of each of the books, from the read
+        that found them available.
+        """
+        await self._count(loans, authors, 1)
+
+    async def returned(self, loans: Loans, authors: Authors):
+        """
+        Count the books of each `(user_id, book oids)` as returned
+        """
+        await self._count(loans, authors, -1)
+
+    async def deleted(self, user_id: ObjectId, author: str):
+        """
+        A book checked out by the user was deleted
+        """
+        await self._increment(
+            increments(Counter([user_id]), Counter([author]), -1)
+        )
+
+    async def read(
+        self, user_id: Optional[ObjectId] = None, author: Optional[str] = None
+    ) -> dict:
+        """
+        The total, and the counters of the user and the author if given
+        """
+        keys = {TOTAL: "checked_out"}
+        if user_id is not None:
+            keys[user_key(user_id)] = "user_checked_out"
+        if author is not None:
+            keys[author_key(author)] = "author_checked_out"
+        out = {name: 0 for name in keys.values()}
+        async for doc in self.engine.find({"_id": {"$in": list(keys)}}):
+            out[keys[doc["_id"]]] = doc.get(FIELD, 0)
+        return out
+
+    async def _count(self, loans: Loans, authors: Authors, sign: int):
+        users: Counter = Counter()
+        by_author: Counter = Counter()
+        for user_id, oids in loans:
+            users[user_id] += len(oids)
+            by_author.update(authors.get(oid) for oid in oids)
+        await self._increment(increments(users, by_author, sign))
+
+    async def _increment(self, amounts: Dict[str, int]):
+        # The write the counters follow is done, never fail it here
+        try:
+            await self.engine.increment(FIELD, amounts)
+        except PyMongoError as e:
+            logger.warning("Loan counters drifted by %s: %s", amounts, e)
+
+
+def count_loans(books: Collection) -> Dict[str, int]:
+    """
+    The counters as they should be, from a scan of the books
+    """
+    users: Counter = Counter()
+    authors: Counter = Counter()
+    pipeline = [
+        {"$match": {"checked_out_by": {"$ne": None}}},
+        {
+            "$group": {
+                "_id": {"user": "$checked_out_by", "author": "$author"},
+                "n": {"$sum": 1},
+            }
+        },
+    ]
+    for group in books.aggregate(pipeline, allowDiskUse=True):
+        users[group["_id"]["user"]] += group["n"]
+        authors[group["_id"].get("author")] += group["n"]
+    return increments(users, authors, 1)
+
+
+def stats_drift(
+    expected: Dict[str, int], stats: Collection
+) -> Dict[str, Tuple[int, int]]:
+    """
+    Counters of the stats collection that differ from `expected`,
+    as `key: (expected, stored)`
+    """
+    stored = {doc["_id"]: doc.get(FIELD, 0) for doc in stats.find()}
+    return {
+        key: (expected.get(key, 0), stored.get(key, 0))
+        for key in expected.keys() | stored.keys()
+        if expected.get(key, 0) != stored.get(key, 0)
+    }
@@ -1,20 +1,68 @@
+import logging
+from typing import Optional
+
+from core.config import Settings, get_settings
+from core.metrics import MetricsMiddleware, metrics
+from core.profiling import ProfilingMiddleware
+from core.security import PasswordHasher
+from db.indexes import ensure_indexes
+from db.mongodb import Database
 from fastapi import FastAPI
-from routers import books, interactions, users
+from routers import books, interactions, stats, users
 from starlette.responses import RedirectResponse
 
-app = FastAPI(
-    title="B2Metric Python Task Assignment",
-    version="0.0.1",
-    contact={
-        "name": "Umur Gökalp",
-        "email": "umur.gokalp@queensu.ca",
-    },
-)
-app.include_router(users.router)
-app.include_router(books.router)
-app.include_router(interactions.router)
-
-
-@app.get("/")
-def index():
-    return RedirectResponse(url="/docs")
+logger = logging.getLogger(__name__)
+
+
+def create_app(settings: Optional[Settings] = None) -> FastAPI:
+    """
+    Build the app. The mongo client and the services are created
+    when the app starts and closed when it shuts down, so apps with
+    different settings can live in the same process.
+    """
+    settings = settings or get_settings()
+    app = FastAPI(
+        title="B2Metric Python Task Assignment",
+        version="0.0.1",
+        contact={
+            "name": "Umur Gökalp",
+            "email": "umur.gokalp@queensu.ca",
+        },
+    )
+    app.state.settings = settings
+    if settings.profiling_enabled:
+        if not settings.profiling_token:
+            logger.warning("Profiling is enabled but PROFILING_TOKEN is not")
+        app.add_middleware(ProfilingMiddleware, settings=settings)
+    if settings.metrics_enabled:
+        app.add_middleware(MetricsMiddleware)
+        app.add_route("/metrics", metrics, include_in_schema=False)
+    app.include_router(users.router)
+    app.include_router(books.router)
+    app.include_router(interactions.router)
+    app.include_router(stats.router)
+
+    @app.on_event("startup")
+    async def connect():
+        app.state.database = Database(settings)
+        app.state.password_hasher = PasswordHasher(settings)
+        if app.state.database.availability is not None:
+            app.state.database.availability.start()
+        if settings.db_create_indexes and app.state.database.db is not None:
+            missing = await ensure_indexes(app.state.database.db)
+            if missing:
+                logger.warning("Missing indexes: %s", ", ".join(missing))
+
+    @app.on_event("shutdown")
+    async def disconnect():
+        await app.state.database.close()
+        app.state.password_hasher.close()
+
+    @app.get("/")
+    def index():
+        return RedirectResponse(url="/docs")
+
+    return app
+
+
+app = create_app()
@@ -1,4 +1,4 @@
-from typing import Optional
+from typing import List, Optional
 
 from bson import ObjectId
 
@@ -36,3 +36,26 @@ class UpdateBookModel(BookModel, metaclass=AllOptional):
     """
 
     pass
+
+
+def book_query(
+    author: Optional[str] = None,
+    checked_out_by: Optional[str] = None,
+    available: Optional[bool] = None,
+) -> dict:
+    """
+    Mongo query of the books matching all the given filters.
+    Raises ValueError if `checked_out_by` is not a valid objectid
+    """
+    conditions: List[dict] = []
+    if author is not None:
+        conditions.append({"author": author})
+    if checked_out_by is not None:
+        if not ObjectId.is_valid(checked_out_by):
+            raise ValueError("Invalid checked_out_by")
+        conditions.append({"checked_out_by": ObjectId(checked_out_by)})
+    if available is not None:
+        conditions.append(
+            {"checked_out_by": None if available else {"$ne": None}}
+        )
+    return {"$and": conditions} if conditions else {}
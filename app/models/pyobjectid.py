@@ -1,4 +1,4 @@
-from typing import Optional
+from typing import List, Optional
 
 import pydantic
 from bson import ObjectId
@@ -33,6 +33,35 @@ class MongoModel(BaseModel):
 
     id: PyObjectId = Field(default_factory=PyObjectId, alias="_id")
 
+    @classmethod
+    def from_mongo(cls, doc: dict):
+        """
+        Build the model from a document of our own database without
+        validating it again. Fields the model does not have are dropped.
+        """
+        values = {k: v for k, v in doc.items() if k in cls.__fields__}
+        values["id"] = doc["_id"]
+        return cls.construct(**values)
+
+    @classmethod
+    def null_errors(cls, values: dict) -> List[dict]:
+        """
+        Validation errors, in the format of pydantic, for the fields
+        of `values` that are none but may not be. To be checked before
+        writing `values` without validation, e.g. with a patch.
+        """
+        return [
+            {
+                "loc": ["body", name],
+                "msg": "none is not an allowed value",
+                "type": "type_error.none.not_allowed",
+            }
+            for name, value in values.items()
+            if value is None
+            and name in cls.__fields__
+            and not cls.__fields__[name].allow_none
+        ]
+
 
 class AllOptional(pydantic.main.ModelMetaclass):
     """
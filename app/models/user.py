@@ -24,6 +24,19 @@ class UserModel(MongoModel):
         }
 
 
+class PublicUserModel(MongoModel):
+    """
+    What responses show of a user, everything but the password
+    """
+
+    email: str
+    username: str
+
+    class Config:
+        allow_population_by_field_name = True
+        json_encoders = {ObjectId: str}
+
+
 class UpdateUserModel(UserModel, metaclass=AllOptional):
     """
     All optional fields for the UserModel
@@ -1,17 +1,39 @@
-from typing import Optional
+from typing import List, Optional, cast
 
 from bson.errors import InvalidId
 from bson.objectid import ObjectId
+from core.config import Settings, get_app_settings
+from core.export import ExportFormat, make_exporter
+from core.export import projection as export_projection
+from core.responses import MongoJSONResponse, dumps
+from core.streaming import iter_json_records
 from db.crud import CrudService
-from db.mongodb import get_book_service
-from fastapi import Depends, Path, Response, exceptions, status
+from db.mongodb import get_book_reader, get_book_service, get_loan_stats
+from db.stats import LoanStats
+from fastapi import (
+    Body,
+    Depends,
+    Path,
+    Request,
+    Response,
+    exceptions,
+    status,
+)
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
 from fastapi.routing import APIRouter
-from models.book import BookModel, UpdateBookModel
+from models.book import BookModel, UpdateBookModel, book_query
+from pydantic import ValidationError
+from pymongo.errors import DuplicateKeyError
+from routers.pagination import PageParams, page_response
 
+# Reads on this router skip validation and jsonable_encoder,
+# see get_book_reader and MongoJSONResponse
 router = APIRouter(
     prefix="/books",
     tags=["books"],
     responses={404: dict(description="Book not found!")},
+    default_response_class=MongoJSONResponse,
 )
 
 
@@ -28,10 +50,105 @@ async def get_book_object_id(
         return None
 
 
+def get_book_query(
+    author: Optional[str] = None,
+    checked_out_by: Optional[str] = None,
+    available: Optional[bool] = None,
+) -> dict:
+    """
+    Mongo query of the filters shared by the listing and the export.
+    To be used as a dependency.
+    Raises 400 if **checked_out_by** is not a valid objectid
+    """
+    try:
+        return book_query(author, checked_out_by, available)
+    except ValueError as e:
+        raise exceptions.HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail=str(e)
+        )
+
+
+def duplicate_book() -> exceptions.HTTPException:
+    """
+    Error for a write that would give two books the same isbn13
+    """
+    return exceptions.HTTPException(
+        status_code=status.HTTP_409_CONFLICT,
+        detail="A book with this isbn13 already exists",
+    )
+
+
+@router.get("/", status_code=status.HTTP_200_OK)
+async def list_books(
+    query: dict = Depends(get_book_query),
+    page: PageParams = Depends(),
+    book_service: CrudService = Depends(get_book_service),
+):
+    """
+    List **books** ordered by their objectid, **limit** at a time.
+    Pass the **next_page_token** of a response as **page_token**
+    to get the next page. **fields** is a comma separated list
+    of the fields to return.
+    """
+    docs, next_after = await book_service.find_page(
+        query,
+        page.after,
+        page.limit,
+        page.projection(book_service.model_cls),
+    )
+    return page_response(docs, next_after)
+
+
+@router.get(
+    "/export",
+    status_code=status.HTTP_200_OK,
+    response_class=StreamingResponse,
+)
+async def export_books(
+    format: ExportFormat = "ndjson",
+    query: dict = Depends(get_book_query),
+    book_service: CrudService = Depends(get_book_reader),
+    settings: Settings = Depends(get_app_settings),
+):
+    """
+    Export the **books** matching the filters as **format**, one of
+    csv, ndjson or parquet. The file is streamed while the books are
+    read, so exports of any size take the same memory.
+    """
+    model_cls = book_service.model_cls
+    exporter = make_exporter(format, model_cls, settings.export_row_group_size)
+    batch_size = settings.export_batch_size
+
+    async def parts():
+        batch = []
+        async for doc in book_service.find_all(
+            query, export_projection(model_cls), batch_size
+        ):
+            batch.append(doc)
+            if len(batch) >= batch_size:
+                # Encoding a batch takes a while, keep the loop free
+                part = await run_in_threadpool(exporter.write, batch)
+                batch = []
+                if part:
+                    yield part
+        part = await run_in_threadpool(exporter.write, batch)
+        yield part + await run_in_threadpool(exporter.close)
+
+    return StreamingResponse(
+        parts(),
+        media_type=exporter.media_type,
+        headers={
+            "Content-Disposition": (
+                f'attachment; filename="books.{exporter.extension}"'
+            )
+        },
+    )
+
+
 @router.get("/{book_id}", status_code=status.HTTP_200_OK)
 async def find_book(
     book_id: ObjectId = Depends(get_book_object_id),
-    book_service: CrudService = Depends(get_book_service),
+    book_service: CrudService = Depends(get_book_reader),
 ):
     """
     Find a **book** by its objectid.
@@ -40,7 +157,7 @@ async def find_book(
     """
     book = await book_service.find_model_by_id(book_id)
     if book:
-        return book
+        return MongoJSONResponse(book)
     raise exceptions.HTTPException(status_code=status.HTTP_404_NOT_FOUND)
 
 
@@ -50,9 +167,13 @@ async def create_book(
 ):
     """
     Creates a new **book** in the database.
+    Raises 409 if another book has the same isbn13
     """
     # Plain create the model
-    result = await book_service.create_model(book)
+    try:
+        result = await book_service.create_model(book)
+    except DuplicateKeyError:
+        raise duplicate_book()
     if result:
         return result
     raise exceptions.HTTPException(
@@ -60,6 +181,101 @@ async def create_book(
     )
 
 
+@router.post("/bulk", status_code=status.HTTP_201_CREATED)
+async def create_books(
+    request: Request,
+    book_service: CrudService = Depends(get_book_service),
+    settings: Settings = Depends(get_app_settings),
+):
+    """
+    Creates many **books** from a JSON array or NDJSON body.
+    Records are validated as they are received and inserted
+    in chunks. Invalid records and records that can not be
+    inserted, e.g. duplicates, are reported by their position
+    in the body.
+    """
+    inserted = 0
+    errors = []
+    chunk: List[BookModel] = []
+    positions: List[int] = []
+
+    async def flush():
+        nonlocal inserted
+        count, write_errors = await book_service.create_models(chunk)
+        inserted += count
+        for e in write_errors:
+            errors.append(
+                {
+                    "index": positions[e["index"]],
+                    "type": "duplicate" if e["code"] == 11000 else "write",
+                    "detail": e["errmsg"],
+                }
+            )
+        chunk.clear()
+        positions.clear()
+
+    received = 0
+    try:
+        async for record, error in iter_json_records(
+            request.stream(), settings.bulk_insert_max_record_size
+        ):
+            index = received
+            received += 1
+            if error is not None:
+                errors.append(
+                    {"index": index, "type": "json", "detail": error}
+                )
+                continue
+            try:
+                chunk.append(BookModel.parse_obj(record))
+                positions.append(index)
+            except ValidationError as e:
+                errors.append(
+                    {
+                        "index": index,
+                        "type": "validation",
+                        "detail": e.errors(),
+                    }
+                )
+                continue
+            if len(chunk) >= settings.bulk_insert_chunk_size:
+                await flush()
+    except ValueError as e:
+        # The rest of the body can not be read
+        errors.append({"index": received, "type": "json", "detail": str(e)})
+    if chunk:
+        await flush()
+
+    return {"received": received, "inserted": inserted, "errors": errors}
+
+
+@router.post("/lookup", status_code=status.HTTP_200_OK)
+async def lookup_books(
+    book_ids: List[str] = Body(..., example=["615019d8ab766b8cc37cebf7"]),
+    book_service: CrudService = Depends(get_book_reader),
+    settings: Settings = Depends(get_app_settings),
+):
+    """
+    Find many **books** by their objectids.
+    Books are streamed back as NDJSON, one book per line. The last line
+    is `{"missing_ids": [...]}` with the ids that are not valid objectids
+    or do not belong to a book.
+    """
+    oids = [ObjectId(b) if ObjectId.is_valid(b) else None for b in book_ids]
+
+    async def lines():
+        found = set()
+        async for doc in book_service.find_by_ids(
+            list(dict.fromkeys(filter(None, oids))), settings.lookup_chunk_size
+        ):
+            found.add(doc["_id"])
+            yield dumps(book_service.to_model(doc)) + b"\n"
+        missing = [b for b, oid in zip(book_ids, oids) if oid not in found]
+        yield dumps({"missing_ids": missing}) + b"\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+
 @router.patch("/{book_id}", status_code=status.HTTP_200_OK)
 async def update_book(
     book: UpdateBookModel,
@@ -68,17 +284,22 @@ async def update_book(
 ):
     """
     Finds and updates **book** in the database
-    Raises 404 if **book** is not found
-    """
-    # Try to find the book
-    book_found = await book_service.find_model_by_id(book_id)
-    # Swap the old props with new
-    if book_found:
-        update_data = book.dict(exclude_unset=True)
-        updated_book = book_found.copy(update=update_data)
-        book_in_db = await book_service.update_model(
-            book_found.id, updated_book
+    Raises 404 if **book** is not found, 409 if another book
+    has the same isbn13
+    """
+    # Only send the fields that were given
+    update_data = book.dict(exclude_unset=True, exclude={"id"})
+    # The update model takes null for every field, the book does not
+    errors = BookModel.null_errors(update_data)
+    if errors:
+        raise exceptions.HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=errors
         )
+    try:
+        book_in_db = await book_service.patch_model(book_id, update_data)
+    except DuplicateKeyError:
+        raise duplicate_book()
+    if book_in_db:
         return book_in_db
     else:
         return Response(status_code=status.HTTP_404_NOT_FOUND)
@@ -88,11 +309,15 @@ async def update_book(
 async def delete_book(
     book_id: ObjectId = Depends(get_book_object_id),
     book_service: CrudService = Depends(get_book_service),
+    loan_stats: LoanStats = Depends(get_loan_stats),
 ):
     # Try to remove
     deleted = await book_service.remove_model(book_id)
     # Check if removed
     if deleted:
+        book = cast(BookModel, deleted)
+        if book.checked_out_by:
+            await loan_stats.deleted(book.checked_out_by, book.author)
         return Response(status_code=status.HTTP_200_OK)
     else:
         return Response(status_code=status.HTTP_404_NOT_FOUND)
@@ -1,131 +1,425 @@
+import asyncio
 from collections import defaultdict
-from typing import Dict, List
+from typing import Any, Collection, Dict, List, Optional, Union
 
+import orjson
 from bson.objectid import ObjectId
-from celery_worker import checkout
+from celery import group
+from celery.result import GroupResult
+from celery_worker import celery, checkout_chunk
+from core.config import Settings, get_app_settings
+from core.objectids import (
+    PACKED_MEDIA_TYPE,
+    pack_checkout_result,
+    parse_object_ids,
+    unpack_object_ids,
+)
+from core.responses import MongoJSONResponse
+from db.availability import AvailabilityIndex
+from db.batching import CheckoutBatcher
 from db.crud import CrudService
-from db.mongodb import get_book_service, get_user_service
-from fastapi import Body, Depends, Response, status
+from db.mongodb import (
+    get_availability_index,
+    get_book_service,
+    get_checkout_batcher,
+    get_loan_stats,
+    get_user_service,
+)
+from db.stats import LoanStats
+from fastapi import (
+    Body,
+    Depends,
+    Path,
+    Request,
+    Response,
+    exceptions,
+    status,
+)
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse
 from fastapi.routing import APIRouter
-from routers.books import get_book_object_id
 from routers.users import get_user_object_id
 
+# Checkout results can hold 100k ids, serialize them with orjson
 router = APIRouter(
     prefix="",
     tags=["interactions"],
+    default_response_class=MongoJSONResponse,
 )
 
 
-@router.post("/checkout/{user_id}", status_code=status.HTTP_201_CREATED)
+async def read_book_ids(request: Request) -> List[Union[str, ObjectId]]:
+    """
+    Book ids of a checkout, from a JSON array of string ids or an
+    `application/octet-stream` body of ObjectIds packed as 12 bytes each
+    """
+    body = await request.body()
+    if request.headers.get("content-type", "").startswith(PACKED_MEDIA_TYPE):
+        try:
+            return unpack_object_ids(body)
+        except ValueError as e:
+            raise exceptions.HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST, detail=str(e)
+            )
+    try:
+        book_ids = orjson.loads(body)
+    except orjson.JSONDecodeError as e:
+        raise exceptions.HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail=str(e)
+        )
+    if not isinstance(book_ids, list) or not all(
+        isinstance(b, str) for b in book_ids
+    ):
+        raise exceptions.HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail="Expected a list of book ids",
+        )
+    return book_ids
+
+
+# The body of a checkout is read by read_book_ids, describe it here
+CHECKOUT_OPENAPI = {
+    "requestBody": {
+        "required": True,
+        "content": {
+            "application/json": {
+                "schema": {"type": "array", "items": {"type": "string"}},
+                "example": ["615019d8ab766b8cc37cebf7"],
+            },
+            PACKED_MEDIA_TYPE: {
+                "schema": {"type": "string", "format": "binary"}
+            },
+        },
+    }
+}
+PACKED_RESPONSE: Dict[str, Any] = {"content": {PACKED_MEDIA_TYPE: {}}}
+
+
+def accepts_packed(request: Request) -> bool:
+    return PACKED_MEDIA_TYPE in request.headers.get("accept", "")
+
+
+def checkout_response(
+    request: Request,
+    book_ids: List[Union[str, ObjectId]],
+    obook_ids: List[Optional[ObjectId]],
+    processed: Collection[ObjectId],
+) -> Response:
+    """
+    Processed and not processed ids of a checkout, as JSON or packed
+    if the caller accepts `application/octet-stream`. Ids that are not
+    valid object ids can not be packed and are left out of packed results.
+    """
+    if accepts_packed(request):
+        return Response(
+            content=pack_checkout_result(
+                [o for o in obook_ids if o in processed],
+                [o for o in obook_ids if o and o not in processed],
+            ),
+            media_type=PACKED_MEDIA_TYPE,
+            status_code=status.HTTP_201_CREATED,
+        )
+    return MongoJSONResponse(
+        status_code=status.HTTP_201_CREATED,
+        content={
+            "processed_ids": [
+                b for b, o in zip(book_ids, obook_ids) if o in processed
+            ],
+            "not_processed_ids": [
+                b for b, o in zip(book_ids, obook_ids) if o not in processed
+            ],
+        },
+    )
+
+
+@router.post(
+    "/checkout/{user_id}",
+    status_code=status.HTTP_201_CREATED,
+    responses={201: PACKED_RESPONSE},
+    openapi_extra=CHECKOUT_OPENAPI,
+)
 async def checkout_book(
-    book_ids: List[str] = Body(...),
+    request: Request,
+    book_ids: List[Union[str, ObjectId]] = Depends(read_book_ids),
     user_id: ObjectId = Depends(get_user_object_id),
     book_service: CrudService = Depends(get_book_service),
+    user_service: CrudService = Depends(get_user_service),
+    batcher: CheckoutBatcher = Depends(get_checkout_batcher),
+    availability: Optional[AvailabilityIndex] = Depends(
+        get_availability_index
+    ),
+    loan_stats: LoanStats = Depends(get_loan_stats),
+    settings: Settings = Depends(get_app_settings),
 ):
     """
     If book is not checkedout then checkout book
     else return error
+
+    The body is a JSON array of book ids, or the ObjectIds packed as
+    12 bytes each with `Content-Type: application/octet-stream`.
+    With `Accept: application/octet-stream` the result is packed too:
+    the number of processed and not processed ids as two big endian
+    uint32, then the processed ids, then the not processed ids.
+    Large checkouts run as a job, whose results can be packed as well,
+    see **checkout_job**.
     """
+    # Every path writes the user id into the books, make sure it is one
+    user = await user_service.find_model_by_id(user_id)
+    if not user:
+        return Response(
+            content="User not found!", status_code=status.HTTP_404_NOT_FOUND
+        )
 
-    # Turn books ids into object ids
-    obook_ids = [await get_user_object_id(o) for o in book_ids]
-    obook_ids = list(filter(None, obook_ids))
-
-    # First query the database to get the ids of matches
-    id_cursor = book_service.collection.find(
-        {
-            "$and": [
-                {"_id": {"$in": obook_ids}},
-                {"checked_out_by": {"$eq": None}},
-            ]
-        },
-        {"_id": 1},
-    )
-    # Get only the ids, use this compare okay ids with not okay ids,
-    # to return processed and unprocessed ids
-    okay_book_ids = [str(res["_id"]) async for res in id_cursor]
-    not_okay_book_ids = list(set(book_ids) ^ set(okay_book_ids))
-
-    # If # of books to checkout is > 100_000 as per the guideline
-    # Run the celery task
-    if len(book_ids) >= 5:
-        tasks = []
-        for book_id in okay_book_ids:
-            tasks.append(checkout.delay(book_id, str(user_id)))
-        results = [t.get() for t in tasks]
-        return join_on_key(results, ["processed_ids", "not_processed_ids"])
-
-    # Query the database and update each. Use update many because it is faster
-    updates = await book_service.collection.update_many(
-        {
-            "$and": [
-                {"_id": {"$in": obook_ids}},
-                {"checked_out_by": {"$eq": None}},
-            ]
-        },
-        {"$set": {"checked_out_by": user_id}},
-    )
+    # Large checkouts are run as a celery job in the background.
+    # Books are sent in chunks so that each task checks out many books
+    # with a single update. The caller polls the job for the results.
+    # The worker only sees mongo, with the memory engine they stay here.
+    if (
+        len(book_ids) >= settings.checkout_async_threshold
+        and settings.storage_engine != "memory"
+    ):
+        size = settings.checkout_chunk_size
+        book_ids = [str(b) for b in book_ids]
+        # The largest jobs get a queue of their own
+        if len(book_ids) >= settings.checkout_bulk_threshold:
+            queue = settings.celery_bulk_queue
+        else:
+            queue = settings.celery_fast_queue
+        job = group(
+            checkout_chunk.s(book_ids[i : i + size], str(user_id)).set(
+                queue=queue
+            )
+            for i in range(0, len(book_ids), size)
+        )
+        # Talking to the broker blocks, keep it off the event loop
+        result = await run_in_threadpool(start_job, job)
+        return JSONResponse(
+            status_code=status.HTTP_202_ACCEPTED,
+            content={
+                "job_id": result.id,
+                "total": len(result.results),
+                "status_url": f"/checkout/jobs/{result.id}",
+            },
+        )
 
-    # I suspect for most cases this won't be a problem, but
-    # as a cautionary check I make sure at least the lengths match
-    if updates.modified_count != len(okay_book_ids):
-        return Response(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
+    # Turn books ids into object ids, packed ones already are
+    if book_ids and isinstance(book_ids[0], ObjectId):
+        obook_ids = book_ids
+    else:
+        obook_ids = parse_object_ids(book_ids)
+    valid_ids = [o for o in obook_ids if o]
+    # Books known to be checked out are not processed without asking
+    if availability is not None:
+        valid_ids = availability.filter_available(valid_ids)
 
-    return {
-        "processed_ids": okay_book_ids,
-        "not_processed_ids": not_okay_book_ids,
-    }
+    # Small checkouts are merged with concurrent ones, so that many
+    # of them share a single write
+    if len(book_ids) <= settings.checkout_batch_max_books:
+        processed = await batcher.checkout(user_id, valid_ids)
+        return checkout_response(request, book_ids, obook_ids, processed)
+
+    # Look up which books are available a chunk at a time, concurrently.
+    # Each chunk is checked out as soon as its lookup is done.
+    # Authors come along for the loan counters
+    okay_book_ids: Dict[ObjectId, Any] = {}
+    updates: List[asyncio.Future] = []
+    try:
+        async for available in book_service.find_values_chunked(
+            valid_ids,
+            {"checked_out_by": None},
+            "author",
+            settings.checkout_prefetch_chunk_size,
+            settings.checkout_prefetch_concurrency,
+        ):
+            if available:
+                okay_book_ids.update(available)
+                updates.append(
+                    asyncio.ensure_future(
+                        book_service.update_many_by_ids(
+                            list(available),
+                            {"checked_out_by": None},
+                            {"checked_out_by": user_id},
+                        )
+                    )
+                )
+    finally:
+        # The checkouts already started finish and are counted,
+        # also when a lookup or one of them failed
+        results = await asyncio.gather(*updates, return_exceptions=True)
+        failed = [r for r in results if isinstance(r, BaseException)]
+        modified = sum(r for r in results if isinstance(r, int))
+        if failed or modified != len(okay_book_ids):
+            # Some books were taken in between, ask which ones we got
+            okay_book_ids = await book_service.find_values(
+                {
+                    "_id": {"$in": list(okay_book_ids)},
+                    "checked_out_by": user_id,
+                },
+                "author",
+            )
+        await loan_stats.checked_out(
+            [(user_id, list(okay_book_ids))], okay_book_ids
+        )
+        if failed:
+            raise failed[0]
+
+    return checkout_response(request, book_ids, obook_ids, okay_book_ids)
+
+
+@router.get(
+    "/checkout/jobs/{job_id}",
+    status_code=status.HTTP_200_OK,
+    responses={200: PACKED_RESPONSE},
+)
+async def checkout_job(job_id: str, request: Request):
+    """
+    Report the progress of a checkout job started by **checkout_book**.
+    **done** and **total** count the chunks of the job, the id lists
+    hold the results of the chunks that are done so far.
+    If **job_id** does not belong to a job raise 404
+
+    With `Accept: application/octet-stream` the ids are packed as in
+    the result of a checkout, and the counts are sent as the headers
+    `X-Job-Done`, `X-Job-Total` and `X-Job-Failed`.
+    """
+    progress = await run_in_threadpool(job_progress, job_id)
+    if not progress:
+        raise exceptions.HTTPException(status_code=status.HTTP_404_NOT_FOUND)
+    if accepts_packed(request):
+        # Ids that are not valid object ids can not be packed
+        processed = parse_object_ids(progress["processed_ids"])
+        not_processed = parse_object_ids(progress["not_processed_ids"])
+        return Response(
+            content=pack_checkout_result(
+                [o for o in processed if o], [o for o in not_processed if o]
+            ),
+            media_type=PACKED_MEDIA_TYPE,
+            headers={
+                "X-Job-Done": str(progress["done"]),
+                "X-Job-Total": str(progress["total"]),
+                "X-Job-Failed": str(progress["failed"]),
+            },
+        )
+    return MongoJSONResponse(progress)
 
 
-@router.post("/return/{book_id}", status_code=status.HTTP_201_CREATED)
-async def return_book(
-    book_id: ObjectId = Depends(get_book_object_id),
-    user_id: str = Body(...),
+@router.post("/return/{object_id}", status_code=status.HTTP_201_CREATED)
+async def return_books(
+    object_id: str = Path(..., example="615019d8ab766b8cc37cebf7"),
+    body: Union[List[str], str] = Body(...),
     book_service: CrudService = Depends(get_book_service),
     user_service: CrudService = Depends(get_user_service),
+    loan_stats: LoanStats = Depends(get_loan_stats),
 ):
     """
     Implementation works by removing the attached **user**
-    from the book, if there is any.
+    from the books, if they are checked out by that user.
 
+    With a list of book ids as the body, **object_id** is the user
+    and the books are returned with a single update. The response
+    lists the processed and not processed ids like checkout does.
+
+    With a user id as the body, **object_id** is a single book.
     If the book is checked out by another user then 404 is returned.
     """
-    user = await user_service.find_model_by_id(
-        await get_user_object_id(user_id)
-    )
-    book = await book_service.find_model_by_id(book_id)
+    if isinstance(body, list):
+        user_id = await get_user_object_id(object_id)
+        book_ids = body
+    else:
+        user_id = await get_user_object_id(body)
+        book_ids = [object_id]
 
-    # If the book is not found return 404
-    if not book:
+    user = await user_service.find_model_by_id(user_id)
+    if not user:
         return Response(
-            content="Book not found!", status_code=status.HTTP_404_NOT_FOUND
+            content="User not found!", status_code=status.HTTP_404_NOT_FOUND
         )
 
-    # If the book is checked out by another user return 404
-    if book.checked_out_by != user.id:
-        return Response(
-            content="Book is checked out by another user!",
-            status_code=status.HTTP_404_NOT_FOUND,
+    oids = parse_object_ids(book_ids)
+    # Only the books the user has can be returned
+    # Authors come along for the loan counters
+    authors = await book_service.find_values(
+        {"_id": {"$in": list(filter(None, oids))}, "checked_out_by": user.id},
+        "author",
+    )
+    held = list(authors)
+    if held:
+        # A book that is not modified was returned by a concurrent
+        # request of the same user, it is returned either way
+        modified = await book_service.update_many_by_ids(
+            held, {"checked_out_by": user.id}, {"checked_out_by": None}
         )
-    # Can clear
-    book.checked_out_by = None
-    updated = await book_service.update_model(book.id, book)
-    if updated:
+        back = held
+        if modified != len(held):
+            # Count the books that are back, not the ones that were
+            # checked out again in the meantime
+            back = await book_service.find_ids(
+                {"_id": {"$in": held}, "checked_out_by": None}
+            )
+        await loan_stats.returned([(user.id, back)], authors)
+    returned = set(held)
+    processed = [b for b, oid in zip(book_ids, oids) if oid in returned]
+    not_processed = [
+        b for b, oid in zip(book_ids, oids) if oid not in returned
+    ]
+
+    if isinstance(body, list):
+        return {
+            "processed_ids": processed,
+            "not_processed_ids": not_processed,
+        }
+
+    if processed:
         return Response(
             content="Book returned successfully!",
             status_code=status.HTTP_201_CREATED,
         )
-    else:
+    # If the book is not found return 404
+    if not oids[0] or not await book_service.find_model_by_id(oids[0]):
         return Response(
-            content="An error occured",
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            content="Book not found!", status_code=status.HTTP_404_NOT_FOUND
         )
+    # The book is checked out by another user or not at all
+    return Response(
+        content="Book is checked out by another user!",
+        status_code=status.HTTP_404_NOT_FOUND,
+    )
+
+
+def start_job(job: group) -> GroupResult:
+    """
+    Send the job to the broker and save its result
+    so that it can be restored by its id later.
+    """
+    result = job.apply_async()
+    result.save()
+    return result
+
+
+def job_progress(job_id: str) -> Optional[dict]:
+    """
+    Collect the finished parts of a checkout job.
+    If there is no such job return none.
+    """
+    result = GroupResult.restore(job_id, app=celery)
+    if result is None:
+        return None
+
+    done = [r for r in result.results if r.ready()]
+    finished = [r.result for r in done if r.successful()]
+    progress = join_on_key(finished, ["processed_ids", "not_processed_ids"])
+    return {
+        "job_id": job_id,
+        "done": len(done),
+        "total": len(result.results),
+        "failed": len(done) - len(finished),
+        **progress,
+    }
 
 
 def join_on_key(data: List[dict], keys: List[str]):
     out: Dict[str, list] = {k: [] for k in keys}
     for d in data:
         for k, v in d.items():
-            if v:
-                out[k].append(v[0])
+            out[k].extend(v)
     return out
@@ -0,0 +1,83 @@
+import base64
+import binascii
+from typing import List, Optional, Type
+
+from bson.errors import InvalidId
+from bson.objectid import ObjectId
+from fastapi import Query, exceptions, status
+from fastapi.encoders import jsonable_encoder
+from models.pyobjectid import MongoModel
+
+
+def encode_page_token(oid: ObjectId) -> str:
+    """
+    Opaque token for the page that starts after `oid`
+    """
+    return base64.urlsafe_b64encode(oid.binary).decode()
+
+
+def decode_page_token(token: str) -> Optional[ObjectId]:
+    """
+    Turn a token from `encode_page_token` back into the ObjectId.
+    If the token is not valid return None
+    """
+    try:
+        return ObjectId(base64.urlsafe_b64decode(token.encode()))
+    except (binascii.Error, InvalidId, TypeError, ValueError):
+        return None
+
+
+class PageParams:
+    """
+    Query parameters shared by the listing endpoints.
+    To be used as a dependency.
+    """
+
+    def __init__(
+        self,
+        fields: Optional[str] = Query(None, example="name,author"),
+        page_token: Optional[str] = None,
+        limit: int = Query(50, ge=1, le=1000),
+    ):
+        self.fields = fields
+        self.limit = limit
+        self.after = None
+        if page_token is not None:
+            self.after = decode_page_token(page_token)
+            if self.after is None:
+                raise exceptions.HTTPException(
+                    status_code=status.HTTP_400_BAD_REQUEST,
+                    detail="Invalid page token",
+                )
+
+    def projection(self, model_cls: Type[MongoModel]) -> Optional[dict]:
+        """
+        Turn **fields** into a mongo projection, `_id` is always returned.
+        Raises 400 on fields the model does not have.
+        """
+        if not self.fields:
+            return None
+        names = [f.strip() for f in self.fields.split(",") if f.strip()]
+        if not names:
+            return None
+        unknown = [n for n in names if n not in model_cls.__fields__]
+        if unknown:
+            raise exceptions.HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"Unknown fields: {', '.join(unknown)}",
+            )
+        # With only the id asked for, ask for it explicitly. An empty
+        # projection reads as no projection, e.g. `or` in list_users.
+        return {name: 1 for name in names if name != "id"} or {"_id": 1}
+
+
+def page_response(docs: List[dict], next_after: Optional[ObjectId]) -> dict:
+    """
+    Response body of a listing endpoint
+    """
+    return {
+        "items": jsonable_encoder(docs, custom_encoder={ObjectId: str}),
+        "next_page_token": (
+            encode_page_token(next_after) if next_after else None
+        ),
+    }
@@ -0,0 +1,30 @@
+from typing import Optional
+
+from bson.objectid import ObjectId
+from db.mongodb import get_loan_stats
+from db.stats import LoanStats
+from fastapi import Depends, Query, exceptions, status
+from fastapi.routing import APIRouter
+
+router = APIRouter(prefix="/stats", tags=["stats"])
+
+
+@router.get("", status_code=status.HTTP_200_OK)
+async def read_stats(
+    user_id: Optional[str] = Query(None, example="615019d8ab766b8cc37cebf7"),
+    author: Optional[str] = None,
+    loan_stats: LoanStats = Depends(get_loan_stats),
+):
+    """
+    Number of checked out books, and of those the ones checked out by
+    **user_id** and written by **author** when they are given.
+    Counters are kept up to date on every checkout, return and delete,
+    so this never scans the books.
+    """
+    if user_id is not None and not ObjectId.is_valid(user_id):
+        raise exceptions.HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid user_id"
+        )
+    return await loan_stats.read(
+        ObjectId(user_id) if user_id is not None else None, author
+    )
@@ -2,11 +2,13 @@ from typing import Optional
 
 from bson.errors import InvalidId
 from bson.objectid import ObjectId
+from core.security import PasswordHasher, get_password_hasher
 from db.crud import CrudService
-from db.mongodb import get_user_service
+from db.mongodb import get_book_service, get_user_service
 from fastapi import Depends, Path, Response, exceptions, status
 from fastapi.routing import APIRouter
-from models.user import UpdateUserModel, UserModel
+from models.user import PublicUserModel, UpdateUserModel, UserModel
+from routers.pagination import PageParams, page_response
 
 router = APIRouter(
     prefix="/users",
@@ -28,7 +30,35 @@ async def get_user_object_id(
         return None
 
 
-@router.get("/{user_id}")
+@router.get("/")
+async def list_users(
+    email: Optional[str] = None,
+    username: Optional[str] = None,
+    page: PageParams = Depends(),
+    user_service: CrudService = Depends(get_user_service),
+):
+    """
+    List **users** ordered by their objectid, **limit** at a time.
+    Pass the **next_page_token** of a response as **page_token**
+    to get the next page. **fields** is a comma separated list
+    of the fields to return. Passwords are never returned.
+    """
+    query = {}
+    if email is not None:
+        query["email"] = email
+    if username is not None:
+        query["username"] = username
+
+    docs, next_after = await user_service.find_page(
+        query,
+        page.after,
+        page.limit,
+        page.projection(PublicUserModel) or {"password": 0},
+    )
+    return page_response(docs, next_after)
+
+
+@router.get("/{user_id}", response_model=PublicUserModel)
 async def find_user(
     user_id: ObjectId = Depends(get_user_object_id),
     user_service: CrudService = Depends(get_user_service),
@@ -46,35 +76,68 @@ async def find_user(
 
 
 @router.post(
-    "/", response_model=UserModel, status_code=status.HTTP_201_CREATED
+    "/", response_model=PublicUserModel, status_code=status.HTTP_201_CREATED
 )
 async def create_user(
-    user: UserModel, user_service: CrudService = Depends(get_user_service)
+    user: UserModel,
+    user_service: CrudService = Depends(get_user_service),
+    hasher: PasswordHasher = Depends(get_password_hasher),
 ):
     """
     Creates a new user in the database.
+    Only a hash of the password is stored.
     """
+    user.password = await hasher.hash(user.password)
     out = await user_service.create_model(user)
     return out
 
 
-@router.patch("/{user_id}")
+@router.get("/{user_id}/books")
+async def find_user_books(
+    user_id: ObjectId = Depends(get_user_object_id),
+    page: PageParams = Depends(),
+    user_service: CrudService = Depends(get_user_service),
+    book_service: CrudService = Depends(get_book_service),
+):
+    """
+    List the **books** checked out by the **user**,
+    paged the same way as the book listing.
+    If **user_id** does not belong to a user raise 404
+    """
+    if not await user_service.find_model_by_id(user_id):
+        raise exceptions.HTTPException(status_code=status.HTTP_404_NOT_FOUND)
+
+    docs, next_after = await book_service.find_page(
+        {"checked_out_by": user_id},
+        page.after,
+        page.limit,
+        page.projection(book_service.model_cls),
+    )
+    return page_response(docs, next_after)
+
+
+@router.patch("/{user_id}", response_model=PublicUserModel)
 async def update_user(
     user: UpdateUserModel,
     user_id: ObjectId = Depends(get_user_object_id),
     user_service: CrudService = Depends(get_user_service),
+    hasher: PasswordHasher = Depends(get_password_hasher),
 ):
     """
     Finds and updates **user** in the database
     Raises 404 if user is not found
     """
-    user_found = await user_service.find_model_by_id(user_id)
-    if user_found:
-        update_data = user.dict(exclude_unset=True)
-        updated_user = user_found.copy(update=update_data)
-        user_in_db = await user_service.update_model(
-            user_found.id, updated_user
+    update_data = user.dict(exclude_unset=True, exclude={"id"})
+    # The update model takes null for every field, the user does not
+    errors = UserModel.null_errors(update_data)
+    if errors:
+        raise exceptions.HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=errors
         )
+    if "password" in update_data:
+        update_data["password"] = await hasher.hash(update_data["password"])
+    user_in_db = await user_service.patch_model(user_id, update_data)
+    if user_in_db:
         return user_in_db
     else:
         return Response(status_code=status.HTTP_404_NOT_FOUND)
@@ -0,0 +1,136 @@
+import asyncio
+
+from bson import ObjectId
+from db.batching import CheckoutBatcher
+from db.crud import CrudService
+from db.engines import MemoryEngine
+from db.indexes import INDEXES
+from db.stats import LoanStats
+from models.book import BookModel
+
+
+class RacingEngine(MemoryEngine):
+    """
+    Memory engine where the `taken` books are checked out by `thief`
+    between the read and the write of a batch
+    """
+
+    def __init__(self, thief):
+        super().__init__(INDEXES["books"])
+        self.thief = thief
+        self.taken = []
+
+    async def bulk_update(self, updates):
+        for oid in self.taken:
+            self._set(self._docs[oid], {"checked_out_by": self.thief})
+        return await super().bulk_update(updates)
+
+
+async def make_books(engine, count):
+    docs = [
+        dict(
+            _id=ObjectId(),
+            name=f"book {i}",
+            author=f"author {i % 2}",
+            isbn13=str(i),
+            num_pages=100,
+            checked_out_by=None,
+        )
+        for i in range(count)
+    ]
+    await engine.insert_many(docs)
+    return [doc["_id"] for doc in docs]
+
+
+def make_batcher(engine, max_items=100, max_delay=0.01):
+    loan_stats = LoanStats(MemoryEngine())
+    batcher = CheckoutBatcher(
+        CrudService(engine=engine, model_cls=BookModel),
+        loan_stats,
+        max_items=max_items,
+        max_delay=max_delay,
+    )
+    return batcher, loan_stats
+
+
+def test_first_come_first_served():
+    async def main():
+        engine = MemoryEngine(INDEXES["books"])
+        books = await make_books(engine, 3)
+        batcher, loan_stats = make_batcher(engine)
+        first, second = ObjectId(), ObjectId()
+
+        got_first, got_second = await asyncio.gather(
+            batcher.checkout(first, books[:2]),
+            batcher.checkout(second, books[1:]),
+        )
+
+        assert got_first == set(books[:2])
+        assert got_second == {books[2]}
+        assert (await engine.find_one(books[1]))["checked_out_by"] == first
+        assert await loan_stats.read(first) == {
+            "checked_out": 3,
+            "user_checked_out": 2,
+        }
+
+    asyncio.run(main())
+
+
+def test_batch_is_written_when_full():
+    async def main():
+        engine = MemoryEngine(INDEXES["books"])
+        books = await make_books(engine, 4)
+        batcher, _ = make_batcher(engine, max_items=4, max_delay=60)
+        user = ObjectId()
+
+        got = await asyncio.wait_for(
+            asyncio.gather(
+                batcher.checkout(user, books[:2]),
+                batcher.checkout(user, books[2:]),
+            ),
+            timeout=1,
+        )
+        assert got == [set(books[:2]), set(books[2:])]
+
+    asyncio.run(main())
+
+
+def test_books_taken_meanwhile_are_not_processed():
+    async def main():
+        thief = ObjectId()
+        engine = RacingEngine(thief)
+        books = await make_books(engine, 4)
+        engine.taken = [books[0], books[3]]
+        batcher, loan_stats = make_batcher(engine)
+        first, second = ObjectId(), ObjectId()
+
+        got_first, got_second = await asyncio.gather(
+            batcher.checkout(first, books[:2]),
+            batcher.checkout(second, books[2:]),
+        )
+
+        assert got_first == {books[1]}
+        assert got_second == {books[2]}
+        assert (await engine.find_one(books[0]))["checked_out_by"] == thief
+        # Only the books the batch got are counted
+        assert await loan_stats.read(first, "author 1") == {
+            "checked_out": 2,
+            "user_checked_out": 1,
+            "author_checked_out": 1,
+        }
+
+    asyncio.run(main())
+
+
+def test_unavailable_books_are_not_processed():
+    async def main():
+        engine = MemoryEngine(INDEXES["books"])
+        books = await make_books(engine, 2)
+        batcher, _ = make_batcher(engine)
+        user = ObjectId()
+
+        assert await batcher.checkout(user, books[:1]) == {books[0]}
+        assert await batcher.checkout(user, books) == {books[1]}
+        assert await batcher.checkout(user, [ObjectId()]) == set()
+
+    asyncio.run(main())
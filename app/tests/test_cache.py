@@ -0,0 +1,99 @@
+import asyncio
+
+from bson import ObjectId
+from db.cache import ModelCache
+from db.crud import CrudService
+from db.engines import MemoryEngine
+from models.book import BookModel
+
+
+class GatedEngine(MemoryEngine):
+    """
+    Memory engine whose reads by id wait until `gate` is set
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.gate = asyncio.Event()
+        self.reading = asyncio.Event()
+
+    async def find_one(self, oid):
+        doc = await super().find_one(oid)
+        self.reading.set()
+        await self.gate.wait()
+        return doc
+
+
+def book(**fields) -> dict:
+    doc = dict(
+        _id=ObjectId(),
+        name="Dune",
+        author="Frank Herbert",
+        isbn13="978-0-441-17271-9",
+        num_pages=412,
+        checked_out_by=None,
+    )
+    doc.update(fields)
+    return doc
+
+
+def test_get_returns_what_was_set():
+    cache = ModelCache(maxsize=2, ttl=60, name="test")
+    cache.set("a", 1)
+    assert cache.get("a") == 1
+    assert cache.get("b") is None
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 1
+
+
+def test_least_recently_used_is_evicted():
+    cache = ModelCache(maxsize=2, ttl=60, name="test")
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+
+
+def test_expired_entries_are_dropped():
+    cache = ModelCache(maxsize=2, ttl=-1, name="test")
+    cache.set("a", 1)
+    assert cache.get("a") is None
+
+
+def test_read_invalidated_in_flight_is_not_stored():
+    cache = ModelCache(maxsize=10, ttl=60, name="test")
+    generation = cache.start_read("a")
+    cache.invalidate("a")
+    cache.set("a", "stale", generation)
+    cache.end_read("a", generation)
+    assert cache.get("a") is None
+
+    generation = cache.start_read("a")
+    cache.set("a", "fresh", generation)
+    cache.end_read("a", generation)
+    assert cache.get("a") == "fresh"
+
+
+def test_write_during_a_read_is_not_cached():
+    async def main():
+        engine = GatedEngine()
+        cache = ModelCache(maxsize=10, ttl=60, name="test")
+        service = CrudService(engine=engine, model_cls=BookModel, cache=cache)
+        doc = book()
+        await engine.insert_one(doc)
+
+        read = asyncio.ensure_future(service.find_model_by_id(doc["_id"]))
+        await engine.reading.wait()
+        # The read has its document, the write comes before it returns
+        engine.gate.set()
+        await service.patch_model(doc["_id"], {"name": "Dune Messiah"})
+        stale = await read
+
+        assert stale.name == "Dune"
+        assert cache.get(doc["_id"]) is None
+        found = await service.find_model_by_id(doc["_id"])
+        assert found.name == "Dune Messiah"
+
+    asyncio.run(main())
@@ -0,0 +1,142 @@
+import asyncio
+
+import pytest
+from bson import ObjectId
+from db.engines import MemoryEngine, matches
+from db.indexes import INDEXES
+
+OIDS = sorted(ObjectId() for _ in range(6))
+
+
+def book(i, author, checked_out_by=None, **fields):
+    return dict(
+        _id=OIDS[i],
+        isbn13=str(i),
+        author=author,
+        checked_out_by=checked_out_by,
+        **fields,
+    )
+
+
+DOCS = [
+    book(0, "a", pages=100),
+    book(1, "b", pages=200),
+    book(2, "a", "u", pages=300),
+    book(3, "c", "v", pages=None),
+    book(4, "b"),
+    book(5, "d", pages=50, tags=["x"]),
+]
+
+
+def find(query, **kwargs):
+    async def main():
+        engine = MemoryEngine(INDEXES["books"])
+        await engine.insert_many([dict(doc) for doc in DOCS])
+        return [doc async for doc in engine.find(query, **kwargs)]
+
+    return asyncio.run(main())
+
+
+def found(query, **kwargs):
+    """
+    Positions in DOCS of the documents matching `query`
+    """
+    return sorted(OIDS.index(doc["_id"]) for doc in find(query, **kwargs))
+
+
+@pytest.mark.parametrize(
+    "query, expected",
+    [
+        ({}, [0, 1, 2, 3, 4, 5]),
+        ({"author": "a"}, [0, 2]),
+        ({"author": {"$eq": "b"}}, [1, 4]),
+        ({"author": {"$ne": "a"}}, [1, 3, 4, 5]),
+        ({"author": {"$in": ["a", "c"]}}, [0, 2, 3]),
+        ({"tags": {"$in": [["x"], "y"]}}, [5]),
+        ({"checked_out_by": None}, [0, 1, 4, 5]),
+        ({"checked_out_by": {"$ne": None}}, [2, 3]),
+        ({"checked_out_by": {"$in": [None, "v"]}}, [0, 1, 3, 4, 5]),
+        ({"pages": {"$gt": 100}}, [1, 2]),
+        ({"pages": {"$gte": 100}}, [0, 1, 2]),
+        ({"pages": {"$lt": 200}}, [0, 5]),
+        ({"pages": {"$lte": 200, "$gt": 50}}, [0, 1]),
+        ({"_id": OIDS[1]}, [1]),
+        ({"_id": {"$in": [OIDS[1], OIDS[3], ObjectId()]}}, [1, 3]),
+        ({"_id": {"$in": OIDS[:4]}, "checked_out_by": None}, [0, 1]),
+        ({"$and": [{"author": "b"}, {"pages": {"$gt": 100}}]}, [1]),
+        ({"$or": [{"author": "c"}, {"pages": 50}]}, [3, 5]),
+        ({"$or": [{"_id": {"$in": OIDS[:2]}}, {"author": "c"}]}, [0, 1, 3]),
+    ],
+)
+def test_query(query, expected):
+    assert found(query) == expected
+
+
+def test_unsupported_operator():
+    with pytest.raises(ValueError):
+        matches(DOCS[0], {"pages": {"$regex": "1"}})
+
+
+def test_sorted_by_id_after_a_page():
+    docs = find(
+        {"_id": {"$gt": OIDS[1]}, "checked_out_by": None},
+        sort_by_id=True,
+        limit=1,
+    )
+    assert [doc["_id"] for doc in docs] == [OIDS[4]]
+    docs = find({"_id": {"$gte": OIDS[1]}}, sort_by_id=True, limit=2)
+    assert [doc["_id"] for doc in docs] == OIDS[1:3]
+    docs = find({"author": "b"}, sort_by_id=True)
+    assert [doc["_id"] for doc in docs] == [OIDS[1], OIDS[4]]
+
+
+@pytest.mark.parametrize(
+    "projection, fields",
+    [
+        (None, {"_id", "isbn13", "author", "pages", "checked_out_by"}),
+        ({}, {"_id"}),
+        ({"author": 1}, {"_id", "author"}),
+        ({"author": 1, "_id": 0}, {"author"}),
+        ({"author": 0}, {"_id", "isbn13", "pages", "checked_out_by"}),
+    ],
+)
+def test_projection(projection, fields):
+    assert set(find({"_id": OIDS[0]}, projection=projection)[0]) == fields
+
+
+def test_bulk_update_counts_modified_documents():
+    async def main():
+        engine = MemoryEngine(INDEXES["books"])
+        await engine.insert_many([dict(doc) for doc in DOCS])
+        modified = await engine.bulk_update(
+            [
+                ({"_id": {"$in": OIDS[:3]}}, {"checked_out_by": None}),
+                ({"author": "c"}, {"checked_out_by": "w"}),
+            ]
+        )
+        assert modified == 2
+        # The index follows the update
+        checked_out = [
+            doc["_id"]
+            async for doc in engine.find({"checked_out_by": {"$ne": None}})
+        ]
+        assert checked_out == [OIDS[3]]
+
+    asyncio.run(main())
+
+
+def test_index_follows_replace_and_delete():
+    async def main():
+        engine = MemoryEngine(INDEXES["books"])
+        await engine.insert_many([dict(doc) for doc in DOCS])
+        await engine.replace_one(OIDS[0], {"isbn13": "0", "author": "z"})
+        await engine.delete_one(OIDS[2])
+        by_author = [doc["_id"] async for doc in engine.find({"author": "z"})]
+        assert by_author == [OIDS[0]]
+        assert [doc async for doc in engine.find({"author": "a"})] == []
+        ordered = [
+            doc["_id"] async for doc in engine.find({}, sort_by_id=True)
+        ]
+        assert ordered == OIDS[:2] + OIDS[3:]
+
+    asyncio.run(main())
@@ -0,0 +1,39 @@
+import pytest
+from bson import ObjectId
+from core.objectids import (
+    COUNTS,
+    OBJECT_ID_SIZE,
+    pack_checkout_result,
+    pack_object_ids,
+    parse_object_ids,
+    unpack_object_ids,
+)
+
+
+def test_pack_round_trip():
+    oids = [ObjectId() for _ in range(100)]
+    packed = pack_object_ids(oids)
+    assert len(packed) == OBJECT_ID_SIZE * len(oids)
+    assert unpack_object_ids(packed) == oids
+    assert unpack_object_ids(b"") == []
+
+
+def test_unpack_cut_short():
+    with pytest.raises(ValueError):
+        unpack_object_ids(pack_object_ids([ObjectId()])[:-1])
+
+
+def test_pack_checkout_result():
+    processed = [ObjectId() for _ in range(3)]
+    not_processed = [ObjectId()]
+    packed = pack_checkout_result(processed, not_processed)
+    assert COUNTS.unpack_from(packed) == (3, 1)
+    ids = unpack_object_ids(packed[COUNTS.size :])
+    assert ids == processed + not_processed
+
+
+def test_parse_object_ids():
+    oids = [ObjectId() for _ in range(3)]
+    assert parse_object_ids([str(o) for o in oids]) == oids
+    mixed = [str(oids[0]), "nope", "z" * 24, str(oids[1])]
+    assert parse_object_ids(mixed) == [oids[0], None, None, oids[1]]
@@ -0,0 +1,121 @@
+import asyncio
+import json
+import random
+from typing import Any, List, Optional, Tuple
+
+import pytest
+from core.streaming import iter_json_records
+
+RECORDS: List[Any] = [
+    2.5,
+    -1e5,
+    10,
+    True,
+    None,
+    'a,]"b',
+    "é ü",
+    {"name": "x", "pages": [1, 2.25, {"deep": "]"}]},
+    [],
+]
+
+
+def parse(
+    body: bytes, cuts: List[int], **kwargs
+) -> Tuple[List[Tuple[Any, Optional[str]]], Optional[str]]:
+    """
+    Records of `body` received in chunks that end at `cuts`, and the
+    message of the ValueError that stopped the parse if any
+    """
+
+    async def chunks():
+        start = 0
+        for end in cuts + [len(body)]:
+            yield body[start:end]
+            start = end
+
+    async def collect():
+        records = []
+        try:
+            async for record in iter_json_records(chunks(), **kwargs):
+                records.append(record)
+        except ValueError as e:
+            return records, str(e)
+        return records, None
+
+    return asyncio.run(collect())
+
+
+def every_cut(body: bytes, size: int) -> List[int]:
+    return list(range(size, len(body), size))
+
+
+@pytest.mark.parametrize("size", range(1, 12))
+def test_array_in_chunks_of_any_size(size):
+    body = json.dumps(RECORDS, ensure_ascii=False).encode()
+    records, error = parse(body, every_cut(body, size))
+    assert error is None
+    assert [r for r, _ in records] == RECORDS
+
+
+def test_array_split_at_random_points():
+    rng = random.Random(7)
+    body = json.dumps(RECORDS * 20, ensure_ascii=False).encode()
+    for _ in range(200):
+        cuts = sorted(rng.sample(range(1, len(body)), rng.randint(1, 50)))
+        records, error = parse(body, cuts)
+        assert error is None
+        assert [r for r, _ in records] == RECORDS * 20
+
+
+def test_number_cut_at_a_chunk_boundary():
+    records, error = parse(b"[2.5]", [1, 2, 3, 4])
+    assert error is None
+    assert records == [(2.5, None)]
+
+
+@pytest.mark.parametrize(
+    "body, valid",
+    [
+        (b"[1 2]", [1]),
+        (b"[1,,2]", [1]),
+        (b"[1,]", [1]),
+        (b"[,1]", []),
+        (b'[{"a": 1} {"b": 2}]', [{"a": 1}]),
+        (b"[1x]", []),
+        (b"[1] 2", [1]),
+        (b"[1, 2", [1, 2]),
+    ],
+)
+def test_malformed_array(body, valid):
+    for size in range(1, len(body) + 1):
+        records, error = parse(body, every_cut(body, size))
+        assert error is not None
+        # Records before the error come out whatever the chunking
+        assert [r for r, _ in records] == valid
+
+
+def test_empty_array():
+    assert parse(b" [ ] ", [2]) == ([], None)
+
+
+def test_record_size_is_capped():
+    body = b'["' + b"x" * 100 + b'"]'
+    records, error = parse(body, every_cut(body, 10), max_record_size=50)
+    assert records == []
+    assert error == "Record longer than 50 characters"
+
+
+def test_ndjson_reports_bad_lines_only():
+    body = b'{"a": 1}\nnot json\n\n{"b": 2}'
+    records, error = parse(body, every_cut(body, 3))
+    assert error is None
+    assert records[0] == ({"a": 1}, None)
+    assert records[1][0] is None and records[1][1]
+    assert records[2] == ({"b": 2}, None)
+
+
+def test_ndjson_line_size_is_capped():
+    body = b'{"a": 1}\n' + b"x" * 100
+    records, error = parse(body, every_cut(body, 10), max_record_size=50)
+    assert records == [({"a": 1}, None)]
+    assert error == "Record longer than 50 characters"
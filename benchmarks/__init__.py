@@ -0,0 +1,12 @@
+"""
+Benchmarks for the service. Run them from the repository root, e.g.
+
+    python -m benchmarks.worker_client --help
+"""
+
+import os
+import sys
+
+# The app modules import each other as top level modules (see app/main.py)
+APP_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), "app")
+sys.path.insert(0, os.path.abspath(APP_DIR))
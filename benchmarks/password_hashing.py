@@ -0,0 +1,183 @@
+"""
+Latency of concurrent GET /books/{book_id} while a burst of users is
+created, with passwords hashed on the event loop and in the hashing
+pool. Each setting of PASSWORD_HASH_WORKERS gets its own app, run with
+the memory storage engine, so no database is needed. GETs are measured
+on an idle app first, then during the burst.
+
+    python -m benchmarks.password_hashing --workers 0 --workers 4 \\
+        --concurrency 16 --burst 500 --out hashing.json
+"""
+
+import asyncio
+import json
+import os
+import random
+import time
+from typing import List
+
+import click
+import httpx
+
+from benchmarks.load import Recorder, git_commit, run_stack, seed_over_http
+
+GET = "GET /books/{book_id}"
+
+
+async def get_books(
+    client: httpx.AsyncClient,
+    rec: Recorder,
+    name: str,
+    book_ids: List[str],
+    until,
+):
+    while not until():
+        url = f"/books/{random.choice(book_ids)}"
+        await rec.request(client, name, "GET", url)
+
+
+async def create_users(
+    client: httpx.AsyncClient, rec: Recorder, count: int, concurrency: int
+):
+    todo = iter(range(count))
+
+    async def worker():
+        for i in todo:
+            body = {
+                "email": f"{i}@burst",
+                "username": f"burst{i}",
+                "password": f"password {i}",
+            }
+            await rec.request(
+                client, "POST /users/", "POST", "/users/", json=body
+            )
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+
+
+async def drive(
+    url: str,
+    book_ids: List[str],
+    concurrency: int,
+    idle: float,
+    burst: int,
+    burst_concurrency: int,
+) -> dict:
+    rec = Recorder()
+    limits = httpx.Limits(max_connections=concurrency + burst_concurrency)
+    async with httpx.AsyncClient(
+        base_url=url, limits=limits, timeout=httpx.Timeout(60.0)
+    ) as client:
+        deadline = time.perf_counter() + idle
+        await asyncio.gather(
+            *(
+                get_books(
+                    client,
+                    rec,
+                    f"{GET} (idle)",
+                    book_ids,
+                    lambda: time.perf_counter() >= deadline,
+                )
+                for _ in range(concurrency)
+            )
+        )
+
+        started = time.perf_counter()
+        creating = asyncio.ensure_future(
+            create_users(client, rec, burst, burst_concurrency)
+        )
+        await asyncio.gather(
+            creating,
+            *(
+                get_books(
+                    client, rec, f"{GET} (burst)", book_ids, creating.done
+                )
+                for _ in range(concurrency)
+            ),
+        )
+        elapsed = time.perf_counter() - started
+    return {
+        "burst_s": round(elapsed, 2),
+        "endpoints": rec.report(elapsed),
+    }
+
+
+@click.command()
+@click.option(
+    "--workers",
+    "workers_list",
+    multiple=True,
+    type=int,
+    default=[0, 4],
+    help="PASSWORD_HASH_WORKERS to compare, 0 hashes on the event loop",
+)
+@click.option(
+    "--pool",
+    type=click.Choice(["thread", "process"]),
+    default="thread",
+    help="PASSWORD_HASH_POOL",
+)
+@click.option(
+    "--algorithm",
+    type=click.Choice(["argon2", "bcrypt"]),
+    default="argon2",
+    help="PASSWORD_HASH_ALGORITHM",
+)
+@click.option("--concurrency", default=16, help="Concurrent GET clients")
+@click.option("--idle", default=5.0, help="Seconds of GETs before the burst")
+@click.option("--burst", default=500, help="Users created in the burst")
+@click.option(
+    "--burst-concurrency", default=32, help="Concurrent user creations"
+)
+@click.option("--books", default=1_000, help="Books to seed")
+@click.option("--port", default=8001)
+@click.option("--out", type=click.Path(), default=None, help="Write JSON here")
+def main(
+    workers_list,
+    pool,
+    algorithm,
+    concurrency,
+    idle,
+    burst,
+    burst_concurrency,
+    books,
+    port,
+    out,
+):
+    runs = {}
+    for workers in workers_list:
+        env = {
+            **os.environ,
+            "MONGODB_URL": "mongodb://unused",
+            "DB_NAME": "unused",
+            "STORAGE_ENGINE": "memory",
+            "PASSWORD_HASH_ALGORITHM": algorithm,
+            "PASSWORD_HASH_POOL": pool,
+            "PASSWORD_HASH_WORKERS": str(workers),
+        }
+        with run_stack(port, env, with_worker=False) as url:
+            _, book_ids = seed_over_http(url, 1, books)
+            runs[f"workers={workers}"] = asyncio.run(
+                drive(
+                    url, book_ids, concurrency, idle, burst, burst_concurrency
+                )
+            )
+
+    report = {
+        "commit": git_commit(),
+        "algorithm": algorithm,
+        "pool": pool,
+        "concurrency": concurrency,
+        "burst": burst,
+        "burst_concurrency": burst_concurrency,
+        "runs": runs,
+    }
+    text = json.dumps(report, indent=2)
+    if out:
+        with open(out, "w") as f:
+            f.write(text)
+    click.echo(text)
+
+
+if __name__ == "__main__":
+    main()
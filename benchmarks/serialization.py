@@ -0,0 +1,119 @@
+"""
+CPU cost per request of building and serializing responses, for
+find_book and for a large checkout result. Compares the validating
+path (model validation, jsonable_encoder, JSONResponse) with the fast
+read path (MongoModel.from_mongo, MongoJSONResponse). Also compares
+parsing a large checkout body as JSON, one id at a time and in bulk,
+with unpacking a packed body. No database is needed. The timings
+depend on the pydantic and fastapi versions, so both are reported.
+
+    python -m benchmarks.serialization --ids 100000
+"""
+
+import asyncio
+import json
+import platform
+import timeit
+from typing import List
+
+import click
+import fastapi
+import orjson
+import pydantic
+from bson import ObjectId
+from core.objectids import pack_object_ids, parse_object_ids, unpack_object_ids
+from core.responses import MongoJSONResponse
+from fastapi.encoders import jsonable_encoder
+from models.book import BookModel
+from pydantic import parse_obj_as
+from routers.users import get_user_object_id
+from starlette.responses import JSONResponse
+
+from benchmarks.load import git_commit
+
+
+def per_call_us(func, number: int) -> float:
+    """
+    Best of 5 runs, in microseconds per call
+    """
+    return round(
+        min(timeit.repeat(func, number=number, repeat=5)) / number * 1e6, 2
+    )
+
+
+@click.command()
+@click.option("--ids", default=100_000, help="Ids in the checkout result")
+@click.option("--number", default=2_000, help="Calls per find_book run")
+def main(ids, number):
+    doc = {
+        "_id": ObjectId(),
+        "name": "The Hitchhiker's Guide to the Galaxy",
+        "author": "Douglas Adams",
+        "isbn13": "978-0-345-39180-3",
+        "num_pages": 224,
+        "checked_out_by": ObjectId(),
+    }
+
+    def find_book_validated():
+        return JSONResponse(jsonable_encoder(BookModel(**doc))).body
+
+    def find_book_fast():
+        return MongoJSONResponse(BookModel.from_mongo(doc)).body
+
+    assert json.loads(find_book_validated()) == json.loads(find_book_fast())
+
+    result = {
+        "processed_ids": [str(ObjectId()) for _ in range(ids // 2)],
+        "not_processed_ids": [str(ObjectId()) for _ in range(ids // 2)],
+    }
+
+    def checkout_default():
+        return JSONResponse(jsonable_encoder(result)).body
+
+    def checkout_fast():
+        return MongoJSONResponse(result).body
+
+    oids = [ObjectId() for _ in range(ids)]
+    json_body = orjson.dumps([str(oid) for oid in oids])
+    packed_body = pack_object_ids(oids)
+
+    def parse_json_per_id():
+        book_ids = parse_obj_as(List[str], json.loads(json_body))
+
+        async def convert():
+            return [await get_user_object_id(b) for b in book_ids]
+
+        return asyncio.run(convert())
+
+    def parse_json_bulk():
+        return parse_object_ids(orjson.loads(json_body))
+
+    def parse_packed():
+        return unpack_object_ids(packed_body)
+
+    assert parse_json_per_id() == parse_json_bulk() == parse_packed()
+
+    results = {
+        "commit": git_commit(),
+        "versions": {
+            "python": platform.python_version(),
+            "pydantic": pydantic.VERSION,
+            "fastapi": fastapi.__version__,
+            "orjson": orjson.__version__,
+        },
+        "find_book_validated_us": per_call_us(find_book_validated, number),
+        "find_book_fast_us": per_call_us(find_book_fast, number),
+        "checkout_ids": ids,
+        "checkout_default_us": per_call_us(checkout_default, 3),
+        "checkout_fast_us": per_call_us(checkout_fast, 3),
+        "checkout_json_body_bytes": len(json_body),
+        "checkout_packed_body_bytes": len(packed_body),
+        "parse_json_per_id_us": per_call_us(parse_json_per_id, 3),
+        "parse_json_bulk_us": per_call_us(parse_json_bulk, 3),
+        "parse_packed_us": per_call_us(parse_packed, 3),
+    }
+    click.echo(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()